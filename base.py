@@ -3,25 +3,48 @@ import random
 import time
 
 import mne
+import numpy as np
 import re
 import json
 
 
-from typing import List, Optional, Callable, TypeVar, Dict, Any
+from typing import List, Optional, Callable, TypeVar, Dict, Any, Union, Tuple
 T = TypeVar('T')
+# Plain string runs right after the previous entry; {"at": <seconds>, "cmd": <string>} runs at a fixed offset
+ScenarioCmd = Union[str, Dict[str, Any]]
 
 import utils
-from interfaces import Parameters, SubprocessInterface
+import tasks
+import timeline
+import metrics
+from clocksync import SampleClock
+from epochs import Epochs
+from dispatch import Dispatcher
+from decimate import MultiRate
+import spatial
+import tfr
+import pyramid
+import catalog
+from interfaces import Parameters, SubprocessInterface, stamp_block
 from cyton_source import CytonSource
 
 
+M_SAMPLES = metrics.REGISTRY.counter('bci_samples_total', 'samples through the acquisition chain')
+M_BLOCKS = metrics.REGISTRY.counter('bci_blocks_total', 'blocks handed to consumers')
+M_DISPATCH = metrics.REGISTRY.histogram('bci_dispatch_seconds', 'time to enqueue a block to every consumer')
+M_SCENARIO_CMDS = metrics.REGISTRY.counter('bci_scenario_commands_total', 'scenario commands executed')
+M_SCENARIO_STEP = metrics.REGISTRY.gauge('bci_scenario_step', 'index of the next scenario command')
+M_SCENARIO_LATENESS = metrics.REGISTRY.histogram('bci_scenario_lateness_seconds', 'timed scenario commands, dispatch after target')
+
+
 class Scenario:
     def __init__(self) -> None:
         self.name = 'default'
         self.topology_name = 'top_8c_10_20'
         self.sampling_rate = 250
-        self.commands = [] # type: List[str]
+        self.commands = [] # type: List[ScenarioCmd]
         self.initial_annotations = {'onset': [], 'duration': [], 'description':[]} # type: Dict
+        self.daisy_interpolate = True
         self.cstep = 0
         self.start = -1
         self.stop = -1
@@ -40,26 +63,69 @@ class Scenario:
         self.commands = scn['commands']
         self.initial_annotations = scn['annotations']
         self.random_seed = scn.get('random_seed', self.random_seed)
+        self.daisy_interpolate = scn.get('daisy_interpolate', self.daisy_interpolate)
         self.cstep = 0
         self.start = -1
         self.stop = -1
         return self
 
+    @staticmethod
+    def _cmd_string(entry: ScenarioCmd) -> str:
+        return entry['cmd'] if isinstance(entry, dict) else entry
+
+    def is_timed(self) -> bool:
+        return any(isinstance(c, dict) and 'at' in c for c in self.commands)
+
+    def _exec(self, ssn: 'Session', executor: Callable, entry: ScenarioCmd) -> None:
+        cmd, *args = self._cmd_string(entry).split(' ')
+        print('>>>', cmd, *args)
+        executor(cmd, ssn, args)
+        M_SCENARIO_CMDS.inc()
+
     def step(self, ssn: 'Session', executor: Callable) -> bool:
         if self.cstep < len(self.commands):
-            cmd, *args = self.commands[self.cstep].split(' ')
-            print('>>>', cmd, *args)
-            executor(cmd, ssn, args)
+            self._exec(ssn, executor, self.commands[self.cstep])
             self.cstep+=1
+            M_SCENARIO_STEP.set(self.cstep)
             return True
         else:
             return False
 
+    def build_timeline(self, ssn: 'Session', executor: Callable) -> timeline.Timeline:
+        tl = timeline.Timeline()
+        offset = 0.0
+        for entry in self.commands[self.cstep:]:
+            if isinstance(entry, dict) and 'at' in entry:
+                at = float(entry['at'])
+                if at < offset:
+                    raise Exception('Scenario entries must be ordered by time: {}'.format(entry))
+                offset = at
+            tl.add(offset, self._cmd_string(entry), lambda e=entry: self._exec(ssn, executor, e))  # type: ignore
+        return tl
+
+    def run_timed(self, ssn: 'Session', executor: Callable) -> None:
+        tl = self.build_timeline(ssn, executor)
+        tl.run(tasks.should_run)
+        for ev in tl.dispatched():
+            M_SCENARIO_LATENESS.observe(max(0.0, ev.lateness))
+            ssn.log.append({
+                'cmd': ev.name,
+                'target': ev.offset,
+                'dispatched': ev.dispatched,
+                'stream': ssn.stream_offset(tl.t0 + ev.dispatched),  # type: ignore
+            })
+        self.cstep += len(tl.dispatched())
+        M_SCENARIO_STEP.set(self.cstep)
+        print(tl.report())
+
     def run(self, ssn: 'Session', executor: Callable) -> None:
         print('Running scenario {}'.format(self.name))
         self.start = int(time.time())
-        while self.step(ssn, executor):
-            pass
+        if self.is_timed():
+            self.run_timed(ssn, executor)
+        else:
+            while self.step(ssn, executor):
+                pass
         self.stop = int(time.time())
         print('Finished scenario in {}'.format(utils.compact_duration(self.stop-self.start)))
 
@@ -67,39 +133,123 @@ class Scenario:
 class Session:
     def __init__(self, scenario: Scenario) -> None:
         self.name = scenario.name
-        self.params = Parameters(sampling_rate=scenario.sampling_rate, topology_name=scenario.topology_name, source=CytonSource)
+        self.params = Parameters(sampling_rate=scenario.sampling_rate, topology_name=scenario.topology_name, source=CytonSource,
+                                 daisy_interpolate=scenario.daisy_interpolate)
 
         self.random_seed = scenario.random_seed
         self.log = []
         self.tstart = 0.0
         self.tstop = 0.0
+        self.tstart_clock = -1.0  # timeline.clock() at stream start
         self.sd_out_file = None
 
         # Runtime
         self.board = None
         self.gui = None # type: Optional[SubprocessInterface]
-        self.callback_seq = [self.params.Source.default_callback] # type: List[Callable[[T], T]]
+        # acquisition-critical chain, run on the streaming thread; its output is fanned out to the dispatcher's consumers
+        self.callback_seq = [self.params.Source.block_callback(self.params)] # type: List[Callable[[Any], Any]]
+        self.dispatcher = Dispatcher()
+        self.rates = None # type: Optional[MultiRate]  # decimated streams, created on first use
+        self.spatial = None # type: Optional[spatial.SpatialFilter]  # live re-referencing stage
+        self.clock = SampleClock(self.params.sampling_rate)
 
         self.data = None # type: Optional[mne.io.RawArray]
+        self.unfiltered = None # type: Optional[mne.io.RawArray]  # data as imported, under a spatial filter; not saved
         self.annotations = scenario.initial_annotations # type: Dict
+        self.epoch_index_cache = {} # type: Dict[Tuple, Tuple[np.ndarray, List[str]]]
 
     def start(self) -> None:
         self.tstart = time.time()
+        self.tstart_clock = timeline.clock()
+        self.clock.reset()
+
+    def stream_offset(self, t: float) -> Optional[float]:
+        # data time (sample index / sampling rate) for a timeline.clock() value; wall offset until samples arrive
+        if self.clock.fitted():
+            return self.clock.index_at(t) / self.params.sampling_rate
+        return t - self.tstart_clock if self.tstart_clock >= 0 else None
 
     def stop(self) -> None:
         self.tstop = time.time()
+        self.flush()
+
+    def flush(self) -> None:
+        # samples still waiting in the assembler go through the rest of the chain, so stopping loses none
+        head = self.callback_seq[0]
+        res = head.flush() if hasattr(head, 'flush') else None
+        if res is None:
+            return
+        for f in self.callback_seq[1:]:
+            res = f(res)
+        self._dispatch(stamp_block(res, self.clock.index - head.lag, self.clock.t_last))
 
-    def add_callback(self, f: Callable[[T], T]) -> None:
-        self.callback_seq.append(f)
+    def _dispatch(self, block: Any) -> None:
+        t0 = time.perf_counter()
+        self.dispatcher.dispatch(block)
+        M_DISPATCH.observe(time.perf_counter() - t0)
+        M_BLOCKS.inc()
+        M_SAMPLES.inc(block.shape[-1])
+
+    def metrics_collector(self) -> Any:
+        # scrape-time view of the session's runtime state, for metrics.REGISTRY.collector
+        def collect() -> Any:
+            st = self.clock.stats()
+            yield ('bci_clock_missed_total', 'counter', 'samples lost between packets', {}, st['missed'])
+            yield ('bci_clock_drift_ppm', 'gauge', 'board clock drift against the host', {}, st['drift_ppm'])
+            yield ('bci_clock_jitter_seconds', 'gauge', 'arrival jitter around the fitted clock', {}, st['jitter'])
+            yield ('bci_sampling_rate_hz', 'gauge', 'measured sampling rate', {}, 1.0 / self.clock.period if self.clock.fitted() else 0.0)
+            yield ('bci_streaming', 'gauge', '1 while a stream is running', {}, 1.0 if self.tstop < self.tstart else 0.0)
+            if hasattr(self.callback_seq[0], 'missing'):
+                yield ('bci_daisy_missing_halves_total', 'counter', 'daisy or board halves lost and held', {}, self.callback_seq[0].missing)
+            for name, c in self.consumer_stats().items():
+                labels = {'consumer': name}
+                yield ('bci_consumer_queue_depth', 'gauge', 'blocks waiting in the consumer queue', labels, c['depth'])
+                yield ('bci_consumer_queue_max_depth', 'gauge', 'deepest the consumer queue got', labels, c['max_depth'])
+                yield ('bci_consumer_processed_total', 'counter', 'blocks processed', labels, c['processed'])
+                yield ('bci_consumer_dropped_total', 'counter', 'blocks dropped on overflow', labels, c['dropped'])
+                yield ('bci_consumer_errors_total', 'counter', 'consumer calls that raised', labels, c['errors'])
+                yield ('bci_consumer_busy_seconds_total', 'counter', 'time spent in the consumer', labels, c['busy'])
+                yield ('bci_consumer_alive', 'gauge', '0 if the worker thread died', labels, 1.0 if c['alive'] else 0.0)
+        return collect
+
+    def add_callback(self, f: Callable[[T], Any], critical: bool = False, name: Optional[str] = None,
+                     maxlen: int = 1024, overflow: str = 'drop_oldest', rate: Optional[int] = None) -> None:
+        # critical stages transform the value in line; the rest consume it on their own worker.
+        # With a rate below the sampling rate f gets the decimated stream, on its own worker too
+        if rate is not None and rate < self.params.sampling_rate:
+            if self.rates is None:
+                self.rates = MultiRate(self.params.nchannels, self.params.sampling_rate)
+                # filter state needs every sample, so this one never drops; it only decimates and enqueues
+                self.dispatcher.add(self.rates, 'decimate', maxlen=1 << 16, overflow='block')
+            self.rates.subscribe(rate, f, name, maxlen, overflow)
+        elif critical:
+            self.callback_seq.append(f)
+        else:
+            self.dispatcher.add(f, name, maxlen, overflow)
 
-    def callback(self, inp: T) -> T:  # returns same type as inp
+    def remove_callback(self, f: Callable[[T], Any]) -> None:
+        if f in self.callback_seq:
+            self.callback_seq.remove(f)
+        elif self.rates is None or not self.rates.unsubscribe(f):
+            self.dispatcher.remove(f)
+
+    def callback(self, inp: T) -> Any:
+        # one raw sample in; consumers get int32 count Blocks (Source.scale converts to microvolts)
+        # stamped with the sample index and arrival time of their last sample
+        self.clock.stamp(inp)
         res = inp
         for f in self.callback_seq:
             res = f(res)
+            if res is None:  # block not complete yet
+                return None
+        res = stamp_block(res, self.clock.index - self.callback_seq[0].lag, self.clock.t_last)
+        self._dispatch(res)
         return res
         # return reduce(lambda val, f: f(val), G_callback_seq, initial=inp)
 
     def import_data(self, fname: Optional[str] = None) -> None:
+        self.epoch_index_cache = {}
+        self.unfiltered = None
         if fname:
             self.data = self.params.Source.import_data(fname, self.params)
         elif self.sd_out_file:
@@ -110,14 +260,79 @@ class Session:
             self.data.set_annotations(a)  # type: ignore
 
         if self.tstop == 0.0 and self.data is not None:
-            self.tstop = self.tstart + (self.data.n_times / self.params.sampling_rate)
+            self.tstop = self.tstart + self.clock.duration(self.data.n_times)
+
+    def set_spatial_filter(self, kind: Optional[str], pairs: List[Tuple[str, str]] = []) -> None:
+        # live: re-reference every block right after it is assembled, ahead of all other stages
+        if self.spatial is not None:
+            self.callback_seq.remove(self.spatial)
+            self.spatial = None
+        if kind is None:
+            return
+        filt = spatial.make_filter(kind, self.params.topology_name, pairs)
+        if not filt.preserves_channels():
+            raise Exception('{} changes the channel count; only usable on imported data'.format(kind))
+        self.callback_seq.insert(1, filt)
+        self.spatial = filt
+
+    def spatial_filter_data(self, kind: Optional[str], pairs: List[Tuple[str, str]] = []) -> None:
+        # always from the data as imported, so a second filter replaces the first and None undoes it.
+        # The filtered data carries its own channel names (a bipolar montage has fewer channels)
+        if self.data is None:
+            raise Exception('No data imported')
+        source = self.unfiltered if self.unfiltered is not None else self.data
+        if list(source.ch_names) != list(self.params.electrode_topology):
+            raise Exception('Data is re-referenced and the original was not saved; import it again first')
+        if kind is None:
+            self.data, self.unfiltered = source, None
+        else:
+            self.data = spatial.apply_raw(source, spatial.make_filter(kind, self.params.topology_name, pairs))
+            self.unfiltered = source
+        self.epoch_index_cache = {}
+
+    def spectrogram(self, window: float = 2.0, overlap: float = 0.5) -> tfr.Spectrogram:
+        if self.data is None:
+            raise Exception('No data imported')
+        data = self.data._data  # type: ignore
+        ident = {'session': self.name, 'tstart': self.tstart, 'channels': self.data.ch_names, 'data': tfr.fingerprint(data)}
+        return tfr.spectrogram(data, self.params.sampling_rate, self.data.ch_names, ident, window, overlap)
+
+    def pyramid(self) -> pyramid.Pyramid:
+        if self.data is None:
+            raise Exception('No data imported')
+        data = self.data._data  # type: ignore
+        ident = {'session': self.name, 'tstart': self.tstart, 'channels': self.data.ch_names, 'data': tfr.fingerprint(data)}
+        return pyramid.pyramid(data, self.params.sampling_rate, self.data.ch_names, ident)
+
+    def epoch_index(self, tmin: float, tmax: float) -> Tuple[np.ndarray, List[str]]:
+        # first sample and description of every annotation whose [onset+tmin, onset+tmax) lies in the data
+        if self.data is None:
+            raise Exception('No data imported')
+        # keyed on the annotations' content: they are edited in place (pstart replaces its estimated onsets)
+        key = (tmin, tmax, self.data.n_times, hash((tuple(self.annotations['onset']), tuple(self.annotations['description']))))
+        if key not in self.epoch_index_cache:
+            sr = self.params.sampling_rate
+            nsamples = int(round((tmax - tmin) * sr))
+            starts = np.round((np.asarray(self.annotations['onset'], dtype=np.float64) + tmin) * sr).astype(np.int64)
+            keep = (starts >= 0) & (starts + nsamples <= self.data.n_times)
+            descriptions = [d for d, k in zip(self.annotations['description'], keep) if k]
+            self.epoch_index_cache[key] = (starts[keep], descriptions)
+        return self.epoch_index_cache[key]
+
+    def epochs(self, tmin: float = -0.2, tmax: float = 0.8, description: Optional[str] = None,
+               baseline: Optional[Tuple[float, float]] = None) -> Epochs:
+        starts, descriptions = self.epoch_index(tmin, tmax)
+        sr = self.params.sampling_rate
+        ep = Epochs(self.data._data, starts, int(round((tmax - tmin) * sr)), descriptions, sr, tmin, baseline)  # type: ignore
+        return ep if description is None else ep.select(description)
 
     def __str__(self) -> str:
         pretty = """Session: {} ({} - {})
     Duration: {}
     Sampling rate: {}
     SD file name: {}
-    Data: {}"""
+    Data: {}
+    {}"""
         data_shape = None
         if self.data is not None:
             data_shape = "{} x {}".format(self.data.ch_names, self.data.n_times)
@@ -126,7 +341,8 @@ class Session:
             utils.compact_duration(int(self.tstop - self.tstart)),
             self.params.sampling_rate,
             self.sd_out_file,
-            data_shape
+            data_shape,
+            self.clock
         )
 
     def to_json(self) -> Dict[str, Any]:
@@ -135,16 +351,51 @@ class Session:
     def _strtime(self, timestamp: float) -> str:
         return time.strftime("%Y-%m-%d-%H:%M:%S", time.localtime(timestamp))
 
+    def consumer_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats = self.dispatcher.stats()
+        if self.rates is not None:
+            stats.update(self.rates.stats())
+        return stats
+
+    def stop_consumers(self) -> None:
+        # full-rate consumers first: draining 'decimate' feeds the rate consumers their last blocks
+        self.dispatcher.stop()
+        if self.rates is not None:
+            self.rates.stop()
+            self.rates = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # runtime parts (devices, threads, processes, closures) are not saved
+        state = self.__dict__.copy()
+        state.update(board=None, gui=None, dispatcher=None, rates=None, spatial=None, callback_seq=None, unfiltered=None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        # fields added after a session was saved get their defaults
+        self.__dict__.setdefault('tstart_clock', -1.0)
+        self.__dict__.setdefault('epoch_index_cache', {})
+        self.__dict__.setdefault('unfiltered', None)
+        if 'clock' not in self.__dict__:
+            self.clock = SampleClock(self.params.sampling_rate)
+        self.board = None
+        self.gui = None
+        self.callback_seq = [self.params.Source.block_callback(self.params)]
+        self.dispatcher = Dispatcher()
+        self.rates = None
+        self.spatial = None
+
     def save(self, fname: Optional[str] = None) -> None:
         if not fname:
             fname = 'sessions/' + self.name + '_' + self._strtime(self.tstart) + '.dat'
         with open(fname, 'wb') as out:
             pickle.dump(self, out)
+        try:
+            catalog.Catalog().add(fname, self)
+        except Exception as e:
+            print('WARNING: {} saved but not catalogued: {}'.format(fname, e))
 
     @classmethod
     def load(cls, fname: str) -> 'Session':
         with open(fname, 'rb') as inp:
-             tmp = pickle.load(inp)
-             tmp.board = None
-             tmp.gui = None
-             return tmp
+             return pickle.load(inp)  # runtime state is rebuilt by __setstate__
@@ -0,0 +1,198 @@
+from typing import List, Optional, Any, Dict, Iterable, Tuple
+import time
+
+import numpy as np
+
+# BDF+ (24-bit EDF+): the ADS1299 counts are stored as they are. Symmetric digital range, so that
+# physical = digital * scale exactly, with no offset; -2**23 is clipped to -(2**23-1)
+DIGITAL_MAX = 2**23 - 1
+DIGITAL_MIN = -DIGITAL_MAX
+ANNOTATION_BYTES = 600  # per data record for the 'BDF Annotations' signal: ~20 short annotations
+
+
+def _field(v: Any, width: int) -> bytes:
+    b = str(v).encode('ascii', 'replace')
+    if len(b) > width:
+        b = b[:width]
+    return b.ljust(width)
+
+
+def _num(x: float, width: int = 8) -> str:
+    # the most precise rendering of x that fits the header field
+    for p in range(width, -1, -1):
+        s = '{:.{}f}'.format(x, p)
+        if '.' in s:
+            s = s.rstrip('0').rstrip('.')
+        if len(s) <= width:
+            return s
+    raise Exception('{} does not fit in {} characters'.format(x, width))
+
+
+def _seconds(t: float) -> str:
+    # to the microsecond, without trailing zeros
+    return '{:+.6f}'.format(t).rstrip('0').rstrip('.')
+
+
+def tal(onset: float, duration: float = 0.0, text: str = '') -> bytes:
+    # time-stamped annotation list entry: +onset[\x15duration]\x14text\x14\x00
+    s = _seconds(onset)
+    if duration > 0:
+        s += '\x15' + _seconds(duration)[1:]
+    for c in '\x00\x14\x15':
+        text = text.replace(c, ' ')
+    return (s + '\x14' + text + '\x14').encode('utf-8') + b'\x00'
+
+
+# Writes (nchannels x n) count blocks to a BDF+ file as they come: only the current data record is kept,
+# full records go straight to disk, the record count is filled in on close. Annotations (seconds from the
+# first sample) are written into the record they fall in, or the next records with room
+class BdfWriter:
+    def __init__(self, fname: str, ch_names: List[str], sampling_rate: int, scale: float, start: Optional[float] = None,
+                 record_duration: float = 1.0, annotation_bytes: int = ANNOTATION_BYTES) -> None:
+        self.fname = fname
+        self.nch = len(ch_names)
+        self.spr = int(round(sampling_rate * record_duration))  # samples per record and channel
+        if abs(self.spr - sampling_rate * record_duration) > 1e-9 or self.spr == 0:
+            raise Exception('Record of {}s is not a whole number of samples at {}Hz'.format(record_duration, sampling_rate))
+        self.sampling_rate = sampling_rate
+        self.record_duration = record_duration
+        self.annotation_bytes = -(-annotation_bytes // 3) * 3
+        self.buf = np.empty((self.nch, self.spr), dtype='<i4')
+        self.k = 0  # samples in buf
+        self.records = 0
+        self.pending = [] # type: List[Tuple[float, bytes]]  # (onset, tal), in order
+        self.dropped = 0
+        self.annotations = None # type: Optional[Dict[str, List]]
+        self.seen = 0
+        self.t0 = None # type: Optional[float]  # session time of the first sample, for followed annotations
+        self.out = open(fname, 'wb')
+        self.out.write(self._header(ch_names, scale, time.time() if start is None else start))
+
+    def _header(self, ch_names: List[str], scale: float, start: float) -> bytes:
+        ns = self.nch + 1
+        lt = time.localtime(start)
+        h = [b'\xffBIOSEMI', _field('X X X X', 80),
+             _field('Startdate {} X X X'.format(time.strftime('%d-%b-%Y', lt).upper()), 80),
+             _field(time.strftime('%d.%m.%y', lt), 8), _field(time.strftime('%H.%M.%S', lt), 8),
+             _field(256 * (ns + 1), 8), _field('BDF+C', 44), _field(-1, 8),
+             _field(_num(self.record_duration), 8), _field(ns, 4)]
+        signals = [(name, 'EEG electrode', 'uV', _num(DIGITAL_MIN * scale), _num(DIGITAL_MAX * scale),
+                    DIGITAL_MIN, DIGITAL_MAX, self.spr) for name in ch_names]
+        signals.append(('BDF Annotations', '', '', -1, 1, -2**23, 2**23 - 1, self.annotation_bytes // 3))
+        for i, width in enumerate([16, 80, 8, 8, 8, 8, 8]):
+            h += [_field(s[i], width) for s in signals]
+        h += [_field('', 80) for _ in signals]  # prefiltering
+        h += [_field(s[7], 8) for s in signals]
+        h += [_field('', 32) for _ in signals]
+        return b''.join(h)
+
+    def annotate(self, onset: float, duration: float = 0.0, description: str = '') -> None:
+        entry = (onset, tal(onset, duration, description))
+        if len(entry[1]) > self.annotation_bytes - 32:
+            raise Exception('Annotation {!r} does not fit a data record'.format(description))
+        if self.pending and onset < self.pending[-1][0]:
+            self.pending = sorted(self.pending + [entry], key=lambda e: e[0])
+        else:
+            self.pending.append(entry)
+
+    def follow(self, annotations: Dict[str, List]) -> None:
+        # take annotations from a dict of onset/duration/description lists that keeps growing (Session.annotations)
+        self.annotations = annotations
+        self.seen = 0
+
+    def _take_followed(self) -> None:
+        a = self.annotations
+        if a is None:
+            return
+        n = min(len(a['onset']), len(a['duration']), len(a['description']))
+        t0 = self.t0 or 0.0
+        for i in range(self.seen, n):
+            self.annotate(a['onset'][i] - t0, a['duration'][i], str(a['description'][i]))
+        self.seen = n
+
+    def _annotation_record(self, r: int, last: bool) -> bytes:
+        t = r * self.record_duration
+        out = tal(t)  # time keeping: +t\x14\x14\x00
+        end = t + self.record_duration
+        while self.pending and (last or self.pending[0][0] < end) and len(out) + len(self.pending[0][1]) <= self.annotation_bytes:
+            out += self.pending.pop(0)[1]
+        return out.ljust(self.annotation_bytes, b'\x00')
+
+    def _write_records(self, data: np.ndarray, last: bool = False) -> None:
+        # data: (nch x R*spr) int32, R whole records, converted and written in one go
+        nrec = data.shape[1] // self.spr
+        self._take_followed()
+        rec = np.empty((nrec, self.nch * self.spr * 3 + self.annotation_bytes), dtype=np.uint8)
+        # record-major copy, then the low three bytes of each little-endian int32, a byte plane at a time
+        counts = np.ascontiguousarray(data.astype('<i4', copy=False).reshape(self.nch, nrec, self.spr).transpose(1, 0, 2))
+        src = counts.view(np.uint8).reshape(nrec, -1, 4)
+        dst = rec[:, :-self.annotation_bytes].reshape(nrec, -1, 3)
+        for k in range(3):
+            dst[:, :, k] = src[:, :, k]
+        for i in range(nrec):
+            r = self.records + i
+            rec[i, -self.annotation_bytes:] = np.frombuffer(self._annotation_record(r, last and i == nrec - 1), dtype=np.uint8)
+        rec.tofile(self.out)
+        self.records += nrec
+
+    def write(self, block: np.ndarray) -> None:
+        if block.shape[0] != self.nch:
+            raise Exception('Expected {} channels, got {}'.format(self.nch, block.shape[0]))
+        if block.dtype.kind == 'f':  # re-referenced or decoded data: back to whole counts
+            block = np.rint(block)
+        block = np.clip(block, DIGITAL_MIN, DIGITAL_MAX).astype(np.int32, copy=False)
+        i, n = 0, block.shape[1]
+        if self.k:
+            m = min(self.spr - self.k, n)
+            self.buf[:, self.k:self.k + m] = block[:, :m]
+            self.k += m
+            i = m
+            if self.k < self.spr:
+                return
+            self._write_records(self.buf)
+            self.k = 0
+        whole = (n - i) // self.spr * self.spr
+        if whole:
+            self._write_records(block[:, i:i + whole])
+            i += whole
+        self.k = n - i
+        self.buf[:, :self.k] = block[:, i:]
+
+    def __call__(self, block: Any) -> Any:
+        # as a live consumer: session time of the first sample from the block stamp
+        if self.t0 is None:
+            index = getattr(block, 'index', -1)
+            self.t0 = max(0, index - block.shape[1] + 1) / self.sampling_rate if index >= 0 else 0.0
+        self.write(block)
+        return block
+
+    def close(self) -> None:
+        if self.out.closed:
+            return
+        self._take_followed()
+        if self.k:  # records are whole: the last one is padded by holding the last sample
+            self.buf[:, self.k:] = self.buf[:, self.k - 1:self.k]
+            self._write_records(self.buf, last=True)
+            self.k = 0
+        self.dropped += len(self.pending)
+        if self.pending:
+            print('WARNING: {}: {} annotations after the end of data or over annotation_bytes per record'.format(self.fname, len(self.pending)))
+        self.out.seek(236)
+        self.out.write(_field(self.records, 8))
+        self.out.close()
+
+
+def export(blocks: Iterable[np.ndarray], fname: str, ch_names: List[str], sampling_rate: int, scale: float,
+           start: Optional[float] = None, annotations: Optional[Dict[str, List]] = None, **kwargs: Any) -> int:
+    # count blocks (e.g. CytonSource.iter_counts) to a BDF file; memory is one block plus one record
+    w = BdfWriter(fname, ch_names, sampling_rate, scale, start, **kwargs)
+    n = 0
+    try:
+        if annotations:
+            w.follow(annotations)
+        for block in blocks:
+            w.write(block)
+            n += block.shape[1]
+    finally:
+        w.close()
+    return n
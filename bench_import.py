@@ -0,0 +1,65 @@
+from typing import Callable, Any
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import utils
+
+
+# Import path as it was before utils.read_csv_array, kept as the reference
+def read_csv_naive(name: str) -> np.ndarray:
+    with open(name, 'r') as inp:
+        samples = [[float(s) for s in l.split(',')] for l in inp]
+    arr = np.array(samples).transpose()
+    return np.divide(arr, np.amax(arr, axis=1)[:, np.newaxis])
+
+
+def read_csv_fast(name: str, nchannels: int) -> np.ndarray:
+    arr = utils.read_csv_array(name, nchannels)
+    arr /= np.amax(arr, axis=1)[:, np.newaxis]
+    return arr
+
+
+def read_disk(name: str) -> None:
+    with open(name, 'rb') as inp:
+        while inp.read(1 << 24):
+            pass
+
+
+def timed(label: str, size: int, f: Callable[[], Any]) -> Any:
+    t0 = time.time()
+    res = f()
+    dt = time.time() - t0
+    print('{:10} {:8.3f}s {:8.1f} MB/s'.format(label, dt, size / dt / 1e6))
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare csv import paths')
+    parser.add_argument('--file', help='csv to import; default: generate one')
+    parser.add_argument('--nchannels', type=int, default=8)
+    parser.add_argument('--seconds', type=int, default=600, help='length of generated csv at 250Hz')
+    args = parser.parse_args()
+
+    fname = args.file
+    if not fname:
+        fd, fname = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        data = np.random.randn(args.seconds * 250, args.nchannels) * 50
+        with open(fname, 'w') as out:
+            for r in data:
+                out.write(','.join([str(i) for i in r])+'\n')  # same as utils.open_record
+    size = os.path.getsize(fname)
+    print('{}: {:.1f} MB'.format(fname, size / 1e6))
+
+    timed('disk', size, lambda: read_disk(fname))
+    fast = timed('fast', size, lambda: read_csv_fast(fname, args.nchannels))
+    timed('loadtxt', size, lambda: np.loadtxt(fname, delimiter=','))  # reference C parser
+    naive = timed('naive', size, lambda: read_csv_naive(fname))
+    print('max abs difference: {}'.format(np.max(np.abs(fast - naive))))
+
+    if not args.file:
+        os.remove(fname)
@@ -0,0 +1,61 @@
+from typing import List
+import argparse
+import os
+import tempfile
+import time
+from threading import Thread
+
+import numpy as np
+
+import timeline
+from netstream import Publisher, Subscriber
+
+
+# Throughput with frames published back to back; latency with frames paced at `rate` per second
+def run(address: str, rows: int, cols: int, frames: int, rate: float) -> None:
+    pub = Publisher(address, maxlen=frames)
+    sub = Subscriber(address)
+    while not pub.subscribers:  # wait until accepted
+        time.sleep(0.001)
+    latencies = [] # type: List[float]
+
+    def consume(n: int) -> None:
+        for i, (seq, t, arr) in enumerate(sub):
+            latencies.append(timeline.clock() - t)
+            if i + 1 == n:
+                break
+
+    block = np.random.randn(rows, cols)
+    th = Thread(target=consume, args=(frames,))
+    th.start()
+    t0 = time.time()
+    for _ in range(frames):
+        pub.publish(block)
+    th.join()
+    dt = time.time() - t0
+
+    nlat = min(frames, int(rate))
+    latencies = []
+    th = Thread(target=consume, args=(nlat,))
+    th.start()
+    for i in range(nlat):
+        timeline.wait_until(timeline.clock() + 1.0 / rate)
+        pub.publish(block)
+    th.join()
+    pub.stop()
+    sub.close()
+    lat = np.array(latencies) * 1000
+    print('{:16} {:8.0f} frames/s {:8.1f} MB/s  latency median {:.3f}ms p99 {:.3f}ms'.format(
+        '{} {}x{}'.format(address.split(':')[0], rows, cols), frames / dt, frames * block.nbytes / dt / 1e6,
+        np.median(lat), np.percentile(lat, 99)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loopback throughput/latency of netstream')
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=1000, help='frames per second for the latency run')
+    args = parser.parse_args()
+    sock = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+    for rows, cols in [(8, 1), (16, 1), (8, 250), (16, 1000)]:
+        run('unix:' + sock, rows, cols, args.frames, args.rate)
+        run('tcp:127.0.0.1:47001', rows, cols, args.frames, args.rate)
@@ -0,0 +1,157 @@
+from typing import List, Optional, Any, Dict, Tuple
+import glob
+import os
+import pickle
+import sqlite3
+import time
+from collections import namedtuple
+
+CATALOG = 'sessions/catalog.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT,
+    tstart REAL,
+    tstop REAL,
+    topology TEXT,
+    sampling_rate INTEGER,
+    nchannels INTEGER,
+    sd_file TEXT,
+    mtime REAL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    onset REAL,
+    duration REAL,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_name ON sessions(name);
+CREATE INDEX IF NOT EXISTS sessions_tstart ON sessions(tstart);
+CREATE INDEX IF NOT EXISTS sessions_topology ON sessions(topology);
+CREATE INDEX IF NOT EXISTS annotations_session ON annotations(session_id, description);
+'''
+
+
+# ranges: (onset, end, description) of the matching annotations, seconds into the session
+Match = namedtuple('Match', ['path', 'name', 'tstart', 'tstop', 'topology', 'sampling_rate', 'ranges'])
+
+
+def parse_time(s: str) -> float:
+    # the session file name format (2021-03-04-12:30:00), or just the date
+    for fmt in ('%Y-%m-%d-%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    raise Exception('Bad time {}, expected YYYY-MM-DD[-HH:MM:SS]'.format(s))
+
+
+# Session metadata and annotations in SQLite, so sessions can be found without unpickling any of them
+class Catalog:
+    def __init__(self, path: str = CATALOG) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=10.0)
+        db.execute('PRAGMA foreign_keys = ON')
+        return db
+
+    def add(self, path: str, ssn: Any) -> None:
+        # (re)index one saved session; called by Session.save
+        st = os.stat(path)
+        a = ssn.annotations or {}
+        rows = list(zip(a.get('onset', []), a.get('duration', []), a.get('description', [])))
+        db = self._connect()
+        try:
+            with db:
+                db.execute('DELETE FROM sessions WHERE path = ?', (path,))
+                cur = db.execute(
+                    'INSERT INTO sessions (path, name, tstart, tstop, topology, sampling_rate, nchannels, sd_file, mtime, size) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, ssn.name, ssn.tstart, ssn.tstop, ssn.params.topology_name, ssn.params.sampling_rate,
+                     ssn.params.nchannels, ssn.sd_out_file, st.st_mtime, st.st_size))
+                db.executemany('INSERT INTO annotations (session_id, onset, duration, description) VALUES (?, ?, ?, ?)',
+                               [(cur.lastrowid, float(o), float(d), str(s)) for o, d, s in rows])
+        finally:
+            db.close()
+
+    def scan(self, pattern: str = 'sessions/*.dat') -> Tuple[int, int]:
+        # index files saved before the catalog existed or changed since; forget deleted ones -> (indexed, removed)
+        db = self._connect()
+        try:
+            known = {p: (m, s) for p, m, s in db.execute('SELECT path, mtime, size FROM sessions')}
+            gone = [p for p in known if not os.path.exists(p)]
+            with db:
+                db.executemany('DELETE FROM sessions WHERE path = ?', [(p,) for p in gone])
+        finally:
+            db.close()
+        indexed = 0
+        for path in sorted(glob.glob(pattern)):
+            st = os.stat(path)
+            if known.get(path) == (st.st_mtime, st.st_size):
+                continue
+            try:
+                with open(path, 'rb') as inp:
+                    ssn = pickle.load(inp)
+            except Exception as e:
+                print('WARNING: cannot index {}: {}'.format(path, e))
+                continue
+            self.add(path, ssn)
+            indexed += 1
+        return indexed, len(gone)
+
+    def remove(self, path: str) -> None:
+        db = self._connect()
+        try:
+            with db:
+                db.execute('DELETE FROM sessions WHERE path = ?', (path,))
+        finally:
+            db.close()
+
+    def query(self, name: Optional[str] = None, topology: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, description: Optional[str] = None) -> List[Match]:
+        # all filters optional and combined; name and description accept * wildcards. Sessions overlapping
+        # [since, until] (unix time). With a description only sessions that have such annotations, with their ranges
+        where = []  # type: List[str]
+        args = []  # type: List[Any]
+        if name is not None:
+            where.append('s.name GLOB ?')
+            args.append(name)
+        if topology is not None:
+            where.append('s.topology = ?')
+            args.append(topology)
+        if since is not None:
+            where.append('MAX(s.tstop, s.tstart) >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('s.tstart <= ?')
+            args.append(until)
+        ranges = {} # type: Dict[int, List[Tuple[float, float, str]]]
+        db = self._connect()
+        try:
+            if description is not None:
+                where.append('EXISTS (SELECT 1 FROM annotations a WHERE a.session_id = s.id AND a.description GLOB ?)')
+                args.append(description)
+            sql = 'SELECT s.id, s.path, s.name, s.tstart, s.tstop, s.topology, s.sampling_rate FROM sessions s'
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            found = db.execute(sql + ' ORDER BY s.tstart', args).fetchall()
+            if description is not None:
+                # per session through the (session_id, description) index, like the EXISTS above
+                for sid, *_ in found:
+                    ranges[sid] = [(onset, onset + duration, desc) for onset, duration, desc in db.execute(
+                        'SELECT onset, duration, description FROM annotations WHERE session_id = ? AND description GLOB ? ORDER BY onset',
+                        (sid, description))]
+        finally:
+            db.close()
+        return [Match(path, name, tstart, tstop, topology, sr, ranges.get(sid, []))
+                for sid, path, name, tstart, tstop, topology, sr in found]
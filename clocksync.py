@@ -0,0 +1,103 @@
+from typing import Optional, Any, Dict
+import math
+
+import timeline
+
+PACKET_ID_MOD = 256  # Cyton packet counter is a single byte
+
+
+# Online fit of host time = offset + period * sample index.
+# Exponentially weighted means/covariances keep each update O(1) and let the fit follow slow drift;
+# values are kept relative to the first sample so magnitudes stay small over multi-hour sessions.
+class SampleClock:
+    def __init__(self, sampling_rate: int, window: float = 60.0) -> None:
+        self.sampling_rate = sampling_rate
+        self.min_alpha = 1.0 / max(1.0, window * sampling_rate)
+        self.reset()
+
+    def reset(self) -> None:
+        self.n = 0
+        self.index = -1  # board sample index of the last stamped sample
+        self.last_id = None # type: Optional[int]
+        self.missed = 0
+        self.t_first = 0.0
+        self.t_last = 0.0
+        self.mx = 0.0
+        self.my = 0.0
+        self.vx = 0.0
+        self.vy = 0.0
+        self.cxy = 0.0
+
+    def _next_index(self, packet_id: Optional[int]) -> int:
+        if packet_id is None or self.last_id is None:
+            step = 1
+        else:
+            step = (packet_id - self.last_id) % PACKET_ID_MOD or PACKET_ID_MOD
+            self.missed += step - 1
+        self.last_id = packet_id
+        return self.index + step
+
+    def stamp(self, sample: Any, t: Optional[float] = None) -> int:
+        t = timeline.clock() if t is None else t
+        self.index = self._next_index(getattr(sample, 'id', None))
+        if self.n == 0:
+            self.t_first = t
+        self.t_last = t
+        self.n += 1
+        x = float(self.index)
+        y = t - self.t_first
+        alpha = max(1.0 / self.n, self.min_alpha)
+        dx = x - self.mx
+        dy = y - self.my
+        self.mx += alpha * dx
+        self.my += alpha * dy
+        self.vx = (1.0 - alpha) * (self.vx + alpha * dx * dx)
+        self.vy = (1.0 - alpha) * (self.vy + alpha * dy * dy)
+        self.cxy = (1.0 - alpha) * (self.cxy + alpha * dx * dy)
+        return self.index
+
+    def fitted(self) -> bool:
+        return self.n > 1 and self.vx > 0
+
+    @property
+    def period(self) -> float:
+        # host seconds per board sample
+        return self.cxy / self.vx if self.fitted() else 1.0 / self.sampling_rate
+
+    @property
+    def offset(self) -> float:
+        # host time of board sample 0
+        return self.t_first + self.my - self.period * self.mx
+
+    @property
+    def drift_ppm(self) -> float:
+        return (self.period * self.sampling_rate - 1.0) * 1e6
+
+    @property
+    def jitter(self) -> float:
+        # residual std of arrival times around the fit, seconds
+        if not self.fitted():
+            return 0.0
+        return math.sqrt(max(0.0, self.vy - self.cxy * self.cxy / self.vx))
+
+    def time_at(self, index: float) -> float:
+        return self.offset + self.period * index
+
+    def index_at(self, t: float) -> float:
+        return (t - self.offset) / self.period
+
+    def duration(self, nsamples: int) -> float:
+        return nsamples * self.period
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'samples': self.n,
+            'missed': self.missed,
+            'offset': self.offset,
+            'drift_ppm': self.drift_ppm,
+            'jitter': self.jitter,
+        }
+
+    def __str__(self) -> str:
+        return 'Clock: {} samples ({} missed), drift {:.1f}ppm, jitter {:.3f}ms'.format(
+            self.n, self.missed, self.drift_ppm, self.jitter * 1000)
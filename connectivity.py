@@ -0,0 +1,140 @@
+from typing import List, Callable, Any, Dict, Optional, Sequence, Tuple
+import time
+from collections import deque
+
+import numpy as np
+
+import timeline
+from inference import DEFAULT_BANDS
+
+METHODS = ('coh', 'imcoh', 'plv')
+
+
+class Connectivity:
+    def __init__(self, index: int, values: np.ndarray, latency: float) -> None:
+        self.index = index  # board sample index of the last sample of the newest segment
+        self.values = values  # (nbands x nchannels x nchannels)
+        self.latency = latency  # seconds from that sample's arrival in Session.callback to the matrices
+
+    def __repr__(self) -> str:
+        return 'Connectivity({}, {}, {:.1f}ms)'.format(self.index, self.values.shape, self.latency * 1000)
+
+
+# Pipeline consumer: band-limited coherence (or imaginary coherence, or PLV) between all channel pairs.
+# Every `sampling_rate / rate` samples the last `segment` samples are cut, Hann windowed and FFT'd (all
+# segments a block completes in one batched rfft); the cross spectra of the last `segments` of them are kept
+# summed, Welch style, for the frequencies inside `bands` only: a new segment adds its (freqs x ch x ch)
+# outer products and the one leaving the average subtracts its own, for all bins at once. The sum is
+# rebuilt from the stored spectra, as one batched matrix product, once per pass over them so rounding does
+# not build up. Per-frequency values are averaged over each band, one output per segment however the
+# samples are blocked. PLV is the same average over spectra normalised to unit magnitude
+class CoherenceStage:
+    def __init__(self, nchannels: int, sampling_rate: int, segment: float = 1.0, segments: int = 16, rate: float = 4.0,
+                 bands: Sequence[Tuple[float, float]] = DEFAULT_BANDS, method: str = 'coh', history: int = 1000) -> None:
+        if method not in METHODS:
+            raise Exception('Unknown method {}, expected one of {}'.format(method, ', '.join(METHODS)))
+        self.nchannels = nchannels
+        self.sampling_rate = sampling_rate
+        self.nperseg = int(round(segment * sampling_rate))
+        self.step = max(1, int(round(sampling_rate / rate)))
+        self.segments = segments
+        self.bands = list(bands)
+        self.method = method
+        freqs = np.fft.rfftfreq(self.nperseg, 1.0 / sampling_rate)
+        inside = np.stack([(freqs >= lo) & (freqs < hi) for lo, hi in self.bands])
+        if not inside.any(axis=1).all():
+            raise Exception('A band has no frequency bins at {}s segments'.format(segment))
+        self.bins = np.flatnonzero(inside.any(axis=0))  # only these rfft bins are kept
+        self.freqs = freqs[self.bins]
+        self.band_avg = inside[:, self.bins].astype(np.float64)
+        self.band_avg /= self.band_avg.sum(axis=1, keepdims=True)
+        self.win = np.hanning(self.nperseg)
+        nf = len(self.bins)
+        self.ring = np.zeros((nchannels, 2 * self.nperseg))  # last samples, at count % size
+        self.spectra = np.zeros((segments, nf, nchannels), dtype=np.complex128)  # the segments in the average
+        self.csd = np.zeros((nf, nchannels, nchannels), dtype=np.complex128)  # sum over them
+        self.count = 0  # samples seen
+        self.cut = 0  # segments cut
+        self.latest = None # type: Optional[Connectivity]
+        self.subscribers = [] # type: List[Callable[[Connectivity], Any]]
+        self.durations = deque(maxlen=history) # type: deque
+        self.outputs = 0
+
+    def subscribe(self, f: Callable[[Connectivity], Any]) -> None:
+        self.subscribers.append(f)
+
+    def __call__(self, val: Any) -> Any:
+        arr = np.asarray(val)
+        if arr.ndim == 1:
+            arr = arr[:, np.newaxis]
+        last = getattr(val, 'index', -1)
+        t = getattr(val, 't', -1.0)
+        if t < 0:
+            t = timeline.clock()
+        for i in range(0, arr.shape[1], self.nperseg):  # at most a segment at a time, so the ring still holds it
+            self._push(arr[:, i:i + self.nperseg], last - max(0, arr.shape[1] - i - self.nperseg), t)
+        return val
+
+    def _push(self, arr: np.ndarray, last: int, t: float) -> None:
+        n = arr.shape[1]
+        size = self.ring.shape[1]
+        self.ring[:, np.arange(self.count, self.count + n) % size] = arr
+        first_end = max(self.nperseg, (self.count // self.step + 1) * self.step)  # segments end at multiples of step
+        self.count += n
+        ends = np.arange(first_end, self.count + 1, self.step)
+        if len(ends) == 0:
+            return
+        mark = time.perf_counter()
+        idx = (ends[:, np.newaxis] - self.nperseg + np.arange(self.nperseg)) % size
+        segs = self.ring[:, idx].transpose(1, 0, 2)  # (nseg x nch x nperseg)
+        spec = np.fft.rfft((segs - segs.mean(axis=2, keepdims=True)) * self.win, axis=2)[:, :, self.bins]
+        if self.method == 'plv':
+            spec /= np.maximum(np.abs(spec), 1e-30)
+        spec = spec.transpose(0, 2, 1)  # (nseg x nf x nch)
+        for k, end in enumerate(ends):  # one output per segment, also when a long block completes many
+            self._add(spec[k])
+            if self.cut < self.segments:
+                continue
+            values = self._values()
+            now = time.perf_counter()
+            self.durations.append(now - mark)  # the first one also carries the batch FFT
+            mark = now
+            index = last - (self.count - int(end)) if last >= 0 else int(end) - 1
+            c = Connectivity(index, values, timeline.clock() - t)
+            self.latest = c
+            self.outputs += 1
+            for f in self.subscribers:
+                f(c)
+
+    def _add(self, spec: np.ndarray) -> None:
+        # spec: (nf x nch), the newest segment; replaces the oldest one in the sum
+        slot = self.cut % self.segments
+        old = self.spectra[slot].copy()
+        self.spectra[slot] = spec
+        self.cut += 1
+        if slot == self.segments - 1:  # a pass over the slots ended: exact sum
+            # (nf x nch x nseg) @ (nf x nseg x nch): sum over segments of the outer products, for every bin at once
+            self.csd = np.matmul(self.spectra.transpose(1, 2, 0), self.spectra.transpose(1, 0, 2).conj())
+        else:
+            self.csd += spec[:, :, np.newaxis] * spec[:, np.newaxis, :].conj()
+            self.csd -= old[:, :, np.newaxis] * old[:, np.newaxis, :].conj()
+
+    def _values(self) -> np.ndarray:
+        # (nbands x nch x nch) from the summed cross spectra
+        if self.method == 'plv':
+            con = np.abs(self.csd) / self.segments
+        else:
+            power = np.sqrt(np.maximum(np.einsum('fii->fi', self.csd).real, 1e-30))
+            norm = power[:, :, np.newaxis] * power[:, np.newaxis, :]
+            con = (np.abs(self.csd) if self.method == 'coh' else self.csd.imag) / norm
+        return np.einsum('bf,fij->bij', self.band_avg, con)
+
+    def stats(self) -> Dict[str, Any]:
+        d = np.array(self.durations) * 1000 if self.durations else np.zeros(1)
+        return {
+            'outputs': self.outputs,
+            'segments': self.cut,
+            'p50_ms': float(np.percentile(d, 50)),
+            'max_ms': float(d.max()),
+            'latency_ms': self.latest.latency * 1000 if self.latest else None,
+        }
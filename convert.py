@@ -0,0 +1,128 @@
+from typing import Dict, List, Tuple, Optional
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from interfaces import Parameters
+from cyton_source import CytonSource
+import bdf
+import utils
+
+EXTENSIONS = ('.txt', '.csv')
+
+
+def collect_inputs(patterns: List[str]) -> List[str]:
+    files = [] # type: List[str]
+    for p in patterns:
+        if os.path.isdir(p):
+            names = [os.path.join(p, n) for n in sorted(os.listdir(p))]
+        else:
+            names = sorted(glob.glob(p))
+        files += [n for n in names if os.path.isfile(n) and n.lower().endswith(EXTENSIONS)]
+    return list(dict.fromkeys(files))  # dedup, keep order
+
+
+def output_name(fname: str, out_dir: Optional[str], fmt: str = 'npy') -> str:
+    # keeps the extension, so x.TXT and x.csv next to each other don't share an output
+    base = os.path.basename(fname) + '.' + fmt
+    return os.path.join(out_dir if out_dir else os.path.dirname(fname), base)
+
+
+def check_outputs(pairs: List[Tuple[str, str]]) -> None:
+    # same-named inputs from different directories would race for one file in --out
+    seen = {} # type: Dict[str, str]
+    for f, out in pairs:
+        key = os.path.abspath(out)
+        if key in seen:
+            raise Exception('{} and {} would both be converted to {}'.format(seen[key], f, out))
+        seen[key] = f
+
+
+def settings(fname: str, params: Parameters) -> dict:
+    # what an output depends on besides the input's content; kept next to it in <out>.json
+    return {'input': os.path.abspath(fname), 'size': os.path.getsize(fname), 'topology': params.topology_name,
+            'sampling_rate': params.sampling_rate}
+
+
+def up_to_date(fname: str, out: str, params: Parameters) -> bool:
+    if not os.path.exists(out) or os.path.getmtime(out) < os.path.getmtime(fname):
+        return False
+    try:
+        with open(out + '.json') as inp:
+            return json.load(inp) == settings(fname, params)
+    except (OSError, ValueError):  # converted before sidecars, or by hand
+        return False
+
+
+def convert_file(fname: str, out: str, params: Parameters) -> Tuple[str, int, int, float]:
+    t0 = time.time()
+    if out.endswith('.bdf'):
+        # raw counts, streamed: memory stays at one chunk whatever the file size
+        tmp = out + '.part.bdf'
+        n = bdf.export(params.Source.iter_counts(fname, params), tmp, params.electrode_topology, params.sampling_rate,
+                       params.Source.scale, os.path.getmtime(fname))
+    else:
+        data = params.Source.load_compact(fname, params)
+        tmp = out + '.part.npy'
+        np.save(tmp, data)
+        n = data.shape[1]
+    os.replace(tmp, out)  # never leave a half written file that looks up to date
+    with open(out + '.json', 'w') as f:
+        json.dump(settings(fname, params), f)
+    return fname, os.path.getsize(fname), n, time.time() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert SD .TXT / csv recordings to (channels x samples) .npy arrays or BDF files')
+    parser.add_argument('inputs', nargs='+', help='files, directories or globs')
+    parser.add_argument('--out', help='output directory; default: next to the input')
+    parser.add_argument('--topology', default='top_8c_10_20')
+    parser.add_argument('--sampling_rate', type=int, default=250)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--format', choices=['npy', 'bdf'], default='npy')
+    parser.add_argument('--force', action='store_true', help='convert even if output is up to date')
+    args = parser.parse_args()
+
+    params = Parameters(sampling_rate=args.sampling_rate, topology_name=args.topology, source=CytonSource)
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    pairs = [(f, output_name(f, args.out, args.format)) for f in collect_inputs(args.inputs)]
+    check_outputs(pairs)
+    todo = []
+    for f, out in pairs:
+        if not args.force and up_to_date(f, out, params):
+            print('skip {} (up to date)'.format(f))
+        else:
+            todo.append((f, out))
+    todo.sort(key=lambda t: -os.path.getsize(t[0]))  # biggest first to keep workers evenly loaded
+    print('Converting {} files with {} workers'.format(len(todo), args.jobs))
+
+    t0 = time.time()
+    total_bytes = 0
+    total_samples = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(convert_file, f, out, params): f for f, out in todo}
+        for fut in as_completed(futures):
+            try:
+                fname, size, nsamples, dt = fut.result()
+            except Exception as e:
+                failed += 1
+                print('FAILED {}: {}'.format(futures[fut], e))
+                continue
+            total_bytes += size
+            total_samples += nsamples
+            print('{}: {} samples in {:.2f}s ({:.1f} MB/s)'.format(fname, nsamples, dt, size / max(dt, 1e-9) / 1e6))
+
+    elapsed = time.time() - t0
+    print('Done: {} files ({} failed), {:.1f} MB, {} of data in {} ({:.1f} MB/s)'.format(
+        len(todo) - failed, failed, total_bytes / 1e6,
+        utils.compact_duration(int(total_samples / params.sampling_rate)),
+        utils.compact_duration(int(elapsed)),
+        total_bytes / max(elapsed, 1e-9) / 1e6))
@@ -1,5 +1,5 @@
 import struct
-from typing import List, Iterator, Callable, IO
+from typing import List, Iterator, Callable, IO, Optional, Any
 
 import mne
 from mne.io import RawArray
@@ -8,9 +8,10 @@ from openbci import cyton as bci
 import random
 import time
 
+import tasks
 import utils
 from utils import vec_to_csv
-from interfaces import Parameters, Source
+from interfaces import Parameters, Source, BlockAssembler
 
 # https://docs.openbci.com/docs/02Cyton/CytonSDK
 
@@ -40,6 +41,53 @@ def convert_openbci_input(name: str, nc: int) -> Iterator[List[int]]:
                 yield list(map(convert_int,l[1:nc+1])) # skip timestamp ... skip non-eeg data
 
 
+HEX_VALUE = np.zeros(256, dtype=np.int32)
+HEX_VALUE[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(10)
+HEX_VALUE[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+HEX_VALUE[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+NIBBLE_SHIFTS = np.array([20, 16, 12, 8, 4, 0], dtype=np.int32)
+
+
+def decode_txt_lines(buf: bytes, nc: int) -> np.ndarray:
+    # same line filter as convert_openbci_input; the hex fields of all kept lines are decoded at once
+    fields = []
+    for line in buf.splitlines():
+        l = line.split(b',')
+        if len(l) >= nc+1 and len(l) <= nc+4 and len(l[nc]) == 6:
+            f = b''.join(l[1:nc+1])
+            if len(f) == 6*nc:
+                fields.append(f)
+    digits = np.frombuffer(b''.join(fields), dtype=np.uint8).reshape(-1, nc, 6)
+    v = (HEX_VALUE[digits] << NIBBLE_SHIFTS).sum(axis=2, dtype=np.int32)
+    v -= (v >= 1 << 23).astype(np.int32) << 24  # 24-bit two's complement
+    return np.ascontiguousarray(v.T)  # nc x n int32 counts
+
+
+def iter_txt_counts(name: str, nc: int, chunk_size: int = 1 << 24) -> Iterator[np.ndarray]:
+    # SD card file as (nc x n) int32 count blocks; memory bounded by the chunk size
+    tail = b''
+    with open(name, 'rb') as inp:
+        while True:
+            buf = inp.read(chunk_size)
+            if not buf:
+                break
+            buf = tail + buf
+            cut = buf.rfind(b'\n') + 1
+            tail = buf[cut:]
+            block = decode_txt_lines(buf[:cut], nc)
+            if block.shape[1]:
+                yield block
+    if tail:
+        block = decode_txt_lines(tail, nc)
+        if block.shape[1]:
+            yield block
+
+
+def read_txt_counts(name: str, nc: int) -> np.ndarray:
+    blocks = list(iter_txt_counts(name, nc))
+    return np.concatenate(blocks, axis=1) if blocks else np.zeros((nc, 0), dtype=np.int32)
+
+
 def sampling_rate_string(sr: int) -> bytes:
     if sr == 250:
         return b'~6'
@@ -58,13 +106,124 @@ def sampling_rate_string(sr: int) -> bytes:
     else:
         raise Exception('Unexpected sampling rate')
 
+# With the Daisy module the board alternates packets: daisy channels (9-16) under even packet ids, board
+# channels (1-8) under the following odd id, so a 16-channel sample arrives every second packet. Per packet
+# halves are only paired by id and appended, in channel order, to one flat list of ints; once enough pairs
+# are in, they are converted at once and expanded into a block at the nominal rate, every pair followed by
+# the midpoint to the next pair (interpolate) or by itself. A lost half is held from the previous pair; a
+# pair lost altogether (packet ids skipping a slot) is held whole, so the output keeps one sample per packet
+# id, as Block.index counts them. Samples that already carry every channel (replayed or synthetic data)
+# are assembled as by BlockAssembler.
+class DaisyAssembler(BlockAssembler):
+    def __init__(self, nchannels: int, length: int, channels: Optional[Callable[[Any], List[int]]] = None,
+                 interpolate: bool = True, pool: int = 8) -> None:
+        length = max(4, length + length % 2)
+        super().__init__(nchannels, length, channels, pool)
+        self.nchannels = nchannels
+        self.half = nchannels // 2
+        self.interpolate = interpolate
+        self.npairs = length // 2
+        self.need = (self.npairs + (1 if interpolate else 0)) * nchannels  # interpolating needs the pair after the block
+        self.flat = [] # type: List[int]  # complete pairs: channels 1-8, then 9-16
+        self.held = ([0] * self.half, [0] * (nchannels - self.half))  # halves of the last pair, fill for lost ones
+        self.daisy = self.held[1]  # daisy half of the open pair
+        self.slot = -1  # packet id // 2 of the open pair, while only its daisy half is in
+        self.prev = -1  # slot of the last complete pair
+        self.last_id = 0
+        self.done = [] # type: List[np.ndarray]  # blocks completed by a run of lost pairs
+        self.missing = 0  # halves held from the previous pair
+
+    def __call__(self, sample: Any) -> Optional[np.ndarray]:
+        values = self.channels(sample) if self.channels else sample
+        if len(values) != self.half:
+            return super().__call__(sample)
+        pid = self.last_id = sample.id
+        slot = pid >> 1
+        if slot == self.slot:  # the board half of the open pair: the usual case
+            self.slot = -1
+            return self._pair(values, self.daisy, slot)
+        res = None
+        if self.slot >= 0:  # the open pair lost its board half
+            self.missing += 1
+            res = self._pair(self.held[0], self.daisy, self.slot)
+            self.slot = -1
+        if self.prev >= 0 and (slot - self.prev) % 128 > 1:
+            res = self._lost(slot, res)
+        if not pid & 1:
+            self.slot = slot
+            self.daisy = values
+            return res
+        self.missing += 1  # a board half whose daisy half was lost
+        done = self._pair(values, self.held[1], slot)
+        return res if done is None else done
+
+    def _pair(self, board: List[int], daisy: List[int], slot: int) -> Optional[np.ndarray]:
+        self.flat += board
+        self.flat += daisy
+        self.held = (board, daisy)
+        self.prev = slot
+        return self._emit(self.npairs) if len(self.flat) == self.need else None
+
+    def _lost(self, slot: int, res: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        # hold the last pair for every slot skipped before `slot`; a long run can complete several blocks
+        if res is not None:
+            self.done.append(res)  # held here, so the pool does not hand its buffer out again
+        for _ in range((slot - self.prev) % 128 - 1):
+            self.missing += 2
+            block = self._pair(self.held[0], self.held[1], (self.prev + 1) % 128)
+            if block is not None:
+                self.done.append(block)
+        if not self.done:
+            return None
+        done, self.done = self.done, []
+        return done[0] if len(done) == 1 else np.concatenate(done, axis=1)
+
+    def _emit(self, n: int) -> np.ndarray:
+        nch = self.nchannels
+        pairs = np.array(self.flat, dtype=np.int32).reshape(-1, nch).T  # nchannels x pairs, one conversion
+        self.cur = out = self._next_buffer()
+        even, odd = out[:, 0:2 * n:2], out[:, 1:2 * n:2]
+        even[:] = pairs[:, :n]
+        if self.interpolate:
+            np.add(even, pairs[:, 1:n + 1], out=odd)  # 24-bit counts: the sum fits in int32
+            odd >>= 1
+        else:
+            odd[:] = even
+        # the last sample of the block is the board half of pair n-1
+        self.lag = (self.last_id - (2 * ((self.prev - (pairs.shape[1] - n)) % 128) + 1)) % 256
+        del self.flat[:n * nch]
+        return out if n == self.npairs else out[:, :2 * n]
+
+    def flush(self) -> Optional[np.ndarray]:
+        if self.slot >= 0:  # cannot complete a block: fewer pairs than `need` before closing
+            self.missing += 1
+            self.flat += self.held[0]
+            self.flat += self.daisy
+            self.held = (self.held[0], self.daisy)
+            self.prev, self.slot = self.slot, -1
+        n = len(self.flat) // self.nchannels
+        if n == 0:
+            return super().flush()
+        if self.interpolate:  # the last pair has no successor: hold it
+            self.flat += self.flat[-self.nchannels:]
+        res = self._emit(n)
+        self.lag = (self.last_id - (2 * self.prev + 1)) % 256  # not the held copy: the last pair is the last one in
+        del self.flat[:]
+        return res
+
+
 class CytonSource(Source[bci.OpenBCICyton]):
+    scale = SCALE_FACTOR_EEG
+
     @classmethod
     def setup(self, params: Parameters, port: str) -> bci.OpenBCICyton:
         # timeout to handle case when board will not stream because of SPS > 250 (v3.1.2-freeSD)
         board = bci.OpenBCICyton(port=port, scaled_output=False, log=True, timeout=3)
         # board = FakeBoard(params.sampling_rate)
         time.sleep(0.5)
+        if params.nchannels > 8:
+            board.ser_write(b'C')  # daisy channels; packets are paired by DaisyAssembler, not by the driver
+            time.sleep(0.5)
         board.ser_write(sampling_rate_string(params.sampling_rate))
         time.sleep(0.5)
         board.print_incoming_text()
@@ -74,6 +233,17 @@ class CytonSource(Source[bci.OpenBCICyton]):
     def default_callback(self, sample: bci.OpenBCISample) -> np.ndarray:
         return np.array(sample.channel_data)*SCALE_FACTOR_EEG
 
+    @classmethod
+    def raw_channels(self, sample: bci.OpenBCISample) -> List[int]:
+        return getattr(sample, 'channel_data', sample)  # replayed data comes as plain vectors
+
+    @classmethod
+    def block_callback(self, params: Parameters) -> BlockAssembler:
+        if params.nchannels > 8:
+            return DaisyAssembler(params.nchannels, max(1, params.sampling_rate // 50), self.raw_channels,
+                                  getattr(params, 'daisy_interpolate', True))
+        return super().block_callback(params)
+
     @classmethod
     def sample_to_csv(self, out: IO, sample: bci.OpenBCISample) -> None:
         vec_to_csv(out, self.default_callback(sample))
@@ -84,17 +254,22 @@ class CytonSource(Source[bci.OpenBCICyton]):
 
     @classmethod
     def gen_rand(self, params: Parameters, callback : Callable[[bci.OpenBCISample], None]) -> None:
-        while utils.should_run:
-            sample = bci.OpenBCISample(None, [random.randrange(-255,255)] * params.nchannels, None)
-            callback(sample)
-            time.sleep(1.0/params.sampling_rate)
+        from synth import SyntheticEEG, to_counts
+        gen = SyntheticEEG(params.electrode_topology, params.sampling_rate, seed=random.randrange(2**31))
+        block = max(1, params.sampling_rate // 10)
+        while tasks.should_run():
+            uv, valid = gen.block(block)  # realistic signal, generated a block at a time
+            for counts in to_counts(uv[:, valid]).T:
+                if not tasks.should_run():
+                    break
+                sample = bci.OpenBCISample(None, counts.tolist(), None)
+                callback(sample)
+                time.sleep(1.0/params.sampling_rate)
 
     @classmethod
     def convert_csv(self, name: str, params: Parameters) -> RawArray:
-        with open(name, 'r') as inp:
-            samples = [[float(s) for s in l.split(',')] for l in inp]
-        arr = np.array(samples).transpose()  # group by channel
-        scaled = np.divide(arr, np.amax(arr, axis=1)[:, np.newaxis])
+        scaled = utils.read_csv_array(name, params.nchannels)  # grouped by channel
+        scaled /= np.amax(scaled, axis=1)[:, np.newaxis]
         info = mne.create_info(
             ch_names=params.electrode_topology,
             sfreq = params.sampling_rate,
@@ -106,9 +281,8 @@ class CytonSource(Source[bci.OpenBCICyton]):
 
     @classmethod
     def convert_txt(self, name: str, params:Parameters) -> RawArray:
-        samples = list(convert_openbci_input(name, params.nchannels))
-        arr = np.array(samples).transpose()
-        scaled = np.divide(arr, np.amax(arr, axis=1)[:, np.newaxis])
+        arr = read_txt_counts(name, params.nchannels)
+        scaled = np.divide(arr, np.amax(arr, axis=1)[:, np.newaxis])  # mne keeps float64 anyway
         info = mne.create_info(
             ch_names=params.electrode_topology,
             sfreq = params.sampling_rate,
@@ -118,6 +292,35 @@ class CytonSource(Source[bci.OpenBCICyton]):
         raw = RawArray(scaled, info)
         return raw
 
+    @classmethod
+    def iter_counts(self, name: str, params: Parameters, chunk_size: int = 1 << 24) -> Iterator[np.ndarray]:
+        # int32 count blocks of an SD file, csv record (microvolts) or converted .npy, a chunk at a time
+        lname = name.lower()
+        if lname.endswith('.txt'):
+            yield from iter_txt_counts(name, params.nchannels, chunk_size)
+        elif lname.endswith('.csv'):
+            for block in utils.iter_csv_array(name, params.nchannels, chunk_size=chunk_size):
+                yield np.rint(block / SCALE_FACTOR_EEG).astype(np.int32)
+        elif lname.endswith('.npy'):
+            data = np.load(name, mmap_mode='r')
+            step = max(1, chunk_size // (4 * params.nchannels))
+            for i in range(0, data.shape[1], step):
+                block = data[:, i:i + step]
+                # .TXT.npy hold counts, .csv.npy microvolts (convert.py)
+                yield np.asarray(block) if block.dtype.kind == 'i' else np.rint(block / SCALE_FACTOR_EEG).astype(np.int32)
+        else:
+            raise Exception('Unsupported format; txt, csv or npy expected')
+
+    @classmethod
+    def load_compact(self, name: str, params: Parameters) -> np.ndarray:
+        # without mne: int32 counts from SD files, float32 microvolts from csv records
+        if name.lower().endswith('.txt'):
+            return read_txt_counts(name, params.nchannels)
+        elif name.lower().endswith('.csv'):
+            return utils.read_csv_array(name, params.nchannels, dtype=np.float32)
+        else:
+            raise Exception('Unsupported format; txt or csv expected')
+
     @classmethod
     def import_data(self, name: str, params:Parameters) -> RawArray:
         if name.lower().endswith('.txt'):
@@ -144,10 +347,14 @@ class FakeBoard:
             self.buf = b''
             return t
 
-    def __init__(self, sr, *args, **kwargs):
+    # daisy: 16 channels sent as alternating 8-channel packets like a Cyton with Daisy module,
+    # `drop` of them lost at random
+    def __init__(self, sr, *args, daisy=False, drop=0.0, **kwargs):
         self.ser = FakeBoard.Ser()
         self.streaming = False
         self.sampling_rate = sr
+        self.daisy = daisy
+        self.drop = drop
 
     def ser_write(self, cmd):
         self.ser.write(b'|cmd: '+ cmd + b'|')
@@ -165,8 +372,18 @@ class FakeBoard:
     def gen_sin(self, callback : Callable[[bci.OpenBCISample], None]) -> None:
         phase = 0.0
         step = 1.0/self.sampling_rate
+        packet_id = 0
         while self.streaming:
-            sample = bci.OpenBCISample(None, [(np.sin(phase) + (np.sin(10*phase)/5 if i > 4 else (np.sin(phase*60) if i == 3 else 0)))*4500 for i in range(8)], None)
-            phase += step * 2 * np.pi
-            callback(sample)
-            time.sleep(1.0/self.sampling_rate)
+            values = [(np.sin(phase) + (np.sin(10*phase)/5 if i > 4 else (np.sin(phase*60) if i == 3 else 0)))*4500 for i in range(16 if self.daisy else 8)]
+            if not self.daisy:
+                sample = bci.OpenBCISample(None, values, None)
+                phase += step * 2 * np.pi
+                callback(sample)
+                time.sleep(1.0/self.sampling_rate)
+                continue
+            for half in (values[8:], values[:8]):  # daisy first, under the even id
+                if random.random() >= self.drop:
+                    callback(bci.OpenBCISample(packet_id, half, None))
+                packet_id = (packet_id + 1) % 256
+                time.sleep(1.0/self.sampling_rate)
+            phase += 2 * step * 2 * np.pi
@@ -0,0 +1,111 @@
+from typing import List, Callable, Any, Dict, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from dispatch import Consumer
+from interfaces import stamp_block
+
+
+def design_lowpass(factor: int, taps_per_phase: int = 24) -> np.ndarray:
+    # Blackman windowed sinc; stopband starts at the new Nyquist (0.5/factor cycles/sample)
+    n = factor * taps_per_phase
+    width = 5.5 / n  # Blackman transition width
+    fc = max(0.5 / factor - width / 2, 0.05 / factor)
+    k = np.arange(n) - (n - 1) / 2.0
+    h = 2 * fc * np.sinc(2 * fc * k) * np.blackman(n)
+    return h / h.sum()
+
+
+# Anti-aliased decimation by an integer factor with filter state kept across blocks.
+# Only every factor-th output is computed (polyphase cost), as windows @ taps over a strided view.
+class Decimator:
+    def __init__(self, nchannels: int, factor: int, taps_per_phase: int = 24) -> None:
+        self.nchannels = nchannels
+        self.factor = factor
+        self.taps = design_lowpass(factor, taps_per_phase)[::-1].copy()
+        self.hist = None # type: Optional[np.ndarray]  # last len(taps)-1 inputs
+        self.count = 0  # inputs seen, mod factor
+        self.pending = np.empty((nchannels, factor))
+        self.npending = 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        # (nchannels x n) -> (nchannels x ~n/factor)
+        x = np.asarray(block, dtype=np.float64)
+        L = len(self.taps)
+        if self.hist is None:
+            self.hist = np.repeat(x[:, :1], L - 1, axis=1)  # start from the first value, no step transient
+        buf = np.concatenate([self.hist, x], axis=1)
+        first = (self.factor - 1 - self.count) % self.factor
+        windows = sliding_window_view(buf, L, axis=1)[:, first::self.factor]
+        out = windows @ self.taps
+        self.hist = buf[:, -(L - 1):]
+        self.count = (self.count + x.shape[1]) % self.factor
+        return out
+
+    def process_sample(self, vec: Any) -> Optional[np.ndarray]:
+        # one (nchannels,) sample in; a decimated sample out every factor-th call
+        self.pending[:, self.npending] = vec
+        self.npending += 1
+        if self.npending < self.factor:
+            return None
+        self.npending = 0
+        return self.process(self.pending)[:, 0]
+
+    def __call__(self, val: Any) -> Any:
+        arr = np.asarray(val)
+        return self.process_sample(arr) if arr.ndim == 1 else self.process(arr)
+
+
+# One full-rate stream in, any number of lower-rate streams out. Every subscriber of a rate is a dispatch
+# Consumer of its own, so a slow one only fills its own queue and never stalls the decimation
+class MultiRate:
+    def __init__(self, nchannels: int, sampling_rate: int) -> None:
+        self.nchannels = nchannels
+        self.sampling_rate = sampling_rate
+        self.rates = {} # type: Dict[int, Tuple[Decimator, List[Consumer]]]
+
+    def subscribe(self, rate: int, f: Callable[[Any], Any], name: Optional[str] = None,
+                  maxlen: int = 1024, overflow: str = 'drop_oldest') -> Consumer:
+        if rate <= 0 or self.sampling_rate % rate != 0:
+            raise Exception('Rate {} does not divide sampling rate {}'.format(rate, self.sampling_rate))
+        if rate not in self.rates:
+            self.rates[rate] = (Decimator(self.nchannels, self.sampling_rate // rate), [])
+        c = Consumer(f, '{}@{}Hz'.format(name or getattr(f, '__qualname__', repr(f)), rate), maxlen, overflow)
+        dec, subs = self.rates[rate]
+        self.rates[rate] = (dec, subs + [c])  # swap, never mutate the list being called over
+        return c
+
+    def unsubscribe(self, f: Callable[[Any], Any]) -> bool:
+        for rate, (dec, subs) in list(self.rates.items()):
+            found = [c for c in subs if c.f == f]
+            if found:
+                rest = [c for c in subs if c.f != f]
+                if rest:
+                    self.rates[rate] = (dec, rest)
+                else:
+                    del self.rates[rate]
+                for c in found:
+                    c.stop()
+                return True
+        return False
+
+    def __call__(self, val: Any) -> Any:
+        for dec, subs in list(self.rates.values()):
+            out = dec(val)
+            if out is None or out.size == 0:
+                continue
+            if hasattr(val, 'index'):  # decimated blocks keep the stamp of the full-rate block they end in
+                out = stamp_block(out, val.index, val.t)
+            for c in subs:
+                c.offer(out)
+        return val
+
+    def stop(self) -> None:
+        rates, self.rates = self.rates, {}
+        for _, subs in rates.values():
+            for c in subs:
+                c.stop()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {c.name: c.stats() for _, subs in list(self.rates.values()) for c in subs}
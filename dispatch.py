@@ -0,0 +1,120 @@
+from typing import List, Callable, Any, Dict, Optional
+import queue
+import time
+from threading import Thread
+
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+_STOP = object()  # compared by identity; values are arrays, which don't compare to a sentinel with ==
+
+
+# Runs one pipeline consumer on its own thread behind a bounded queue
+class Consumer:
+    def __init__(self, f: Callable[[Any], Any], name: str, maxlen: int = 1024, overflow: str = 'drop_oldest') -> None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise Exception('Unknown overflow policy {}; expected one of {}'.format(overflow, OVERFLOW_POLICIES))
+        self.f = f
+        self.name = name
+        self.overflow = overflow
+        self.queue = queue.Queue(maxlen) # type: queue.Queue
+        # health counters; written by one thread each, read by anyone
+        self.offered = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None # type: Optional[str]
+        self.max_depth = 0
+        self.busy = 0.0
+        self.thread = Thread(target=self._run, name='consumer-' + name, daemon=True)
+        self.thread.start()
+
+    def offer(self, val: Any) -> None:
+        self.offered += 1
+        q = self.queue
+        try:
+            q.put_nowait(val)
+        except queue.Full:
+            if self.overflow == 'block':
+                q.put(val)
+            elif self.overflow == 'drop_oldest':
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                self.dropped += 1
+                q.put_nowait(val)
+            else:
+                self.dropped += 1
+        depth = q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _run(self) -> None:
+        try:
+            while True:
+                val = self.queue.get()
+                if val is _STOP:
+                    return
+                t0 = time.perf_counter()
+                try:
+                    self.f(val)
+                except Exception as e:
+                    self.errors += 1
+                    self.last_error = repr(e)
+                self.busy += time.perf_counter() - t0
+                self.processed += 1
+                val = None  # don't keep the last block alive while waiting for the next
+        except BaseException as e:  # shows up as alive=False in stats instead of vanishing
+            self.last_error = 'worker died: ' + repr(e)
+            raise
+
+    def alive(self) -> bool:
+        return self.thread.is_alive()
+
+    def stop(self) -> None:
+        if self.alive():  # a dead worker would never drain the queue
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'alive': self.alive(),
+            'offered': self.offered,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'busy': self.busy,
+            'last_error': self.last_error,
+        }
+
+
+# Fans the output of the acquisition-critical chain out to independent consumers;
+# the acquisition thread only pays one non-blocking enqueue per consumer
+class Dispatcher:
+    def __init__(self) -> None:
+        self.consumers = [] # type: List[Consumer]
+
+    def add(self, f: Callable[[Any], Any], name: Optional[str] = None, maxlen: int = 1024, overflow: str = 'drop_oldest') -> Consumer:
+        c = Consumer(f, name or getattr(f, '__qualname__', repr(f)), maxlen, overflow)
+        self.consumers = self.consumers + [c]  # swap, never mutate the list being dispatched over
+        return c
+
+    def remove(self, f: Callable[[Any], Any]) -> bool:
+        found = [c for c in self.consumers if c.f == f]
+        self.consumers = [c for c in self.consumers if c.f != f]
+        for c in found:
+            c.stop()
+        return len(found) > 0
+
+    def dispatch(self, val: Any) -> None:
+        for c in self.consumers:
+            c.offer(val)
+
+    def stop(self) -> None:
+        consumers, self.consumers = self.consumers, []
+        for c in consumers:
+            c.stop()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {c.name: c.stats() for c in self.consumers}
@@ -0,0 +1,95 @@
+from typing import List, Optional, Tuple, Dict, Iterator
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided, sliding_window_view
+
+
+# Epochs over a (nchannels x nsamples) array without copying it.
+# Regularly spaced epochs are one strided view. Irregular ones are views one epoch at a time (indexing,
+# iterating, average); asking for all of them as one array (raw_view, get_data) gathers a copy of
+# n_epochs x nchannels x nsamples, since no single view can describe them.
+class Epochs:
+    def __init__(self, data: np.ndarray, starts: np.ndarray, nsamples: int, descriptions: List[str],
+                 sampling_rate: float, tmin: float = 0.0, baseline: Optional[Tuple[float, float]] = None) -> None:
+        self.source = data
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.nsamples = nsamples
+        self.descriptions = descriptions
+        self.sampling_rate = sampling_rate
+        self.tmin = tmin
+        self.baseline = baseline
+        self._offsets = None # type: Optional[np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return (len(self.starts), self.source.shape[0], self.nsamples)
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.tmin + np.arange(self.nsamples) / self.sampling_rate
+
+    def is_regular(self) -> bool:
+        return len(self.starts) < 3 or bool(np.all(np.diff(self.starts) == self.starts[1] - self.starts[0]))
+
+    def raw_view(self) -> np.ndarray:
+        # (n_epochs x nchannels x nsamples), not baseline corrected. A view when epochs are evenly spaced
+        # (is_regular()), otherwise a copy: iterate for per-epoch views instead when memory matters
+        nch, n = self.source.shape
+        if len(self.starts) == 0:
+            return np.empty((0, nch, self.nsamples), dtype=self.source.dtype)
+        if self.is_regular():
+            step = int(self.starts[1] - self.starts[0]) if len(self.starts) > 1 else 0
+            s0, s1 = self.source.strides
+            return as_strided(self.source[:, self.starts[0]:], shape=self.shape,
+                              strides=(step * s1, s0, s1), writeable=False)
+        windows = sliding_window_view(self.source, self.nsamples, axis=1)  # view: nch x positions x nsamples
+        return windows[:, self.starts].transpose(1, 0, 2)
+
+    def baseline_offsets(self) -> np.ndarray:
+        # (n_epochs x nchannels x 1) means over the baseline interval; computed once
+        if self._offsets is None:
+            if self.baseline is None:
+                self._offsets = np.zeros((len(self.starts), self.source.shape[0], 1), dtype=self.source.dtype)
+            else:
+                b0 = int(round((self.baseline[0] - self.tmin) * self.sampling_rate))
+                b1 = int(round((self.baseline[1] - self.tmin) * self.sampling_rate))
+                b0, b1 = max(0, b0), min(self.nsamples, max(b1, b0 + 1))
+                windows = sliding_window_view(self.source, b1 - b0, axis=1)
+                self._offsets = windows[:, self.starts + b0].mean(axis=2).T[:, :, np.newaxis]
+        return self._offsets
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        s = self.starts[i]
+        epoch = self.source[:, s:s+self.nsamples]
+        return epoch if self.baseline is None else epoch - self.baseline_offsets()[i]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for i in range(len(self.starts)):
+            yield self[i]
+
+    def get_data(self) -> np.ndarray:
+        # baseline corrected (n_epochs x nchannels x nsamples); a view only for evenly spaced epochs without baseline
+        view = self.raw_view()
+        return view if self.baseline is None else view - self.baseline_offsets()
+
+    def average(self) -> np.ndarray:
+        if self.is_regular() or len(self.starts) == 0:
+            return self.get_data().mean(axis=0)
+        total = np.zeros((self.source.shape[0], self.nsamples))
+        for epoch in self:  # one epoch at a time, no n_epochs copy
+            total += epoch
+        return total / len(self.starts)
+
+    def select(self, description: str) -> 'Epochs':
+        idx = [i for i, d in enumerate(self.descriptions) if d == description]
+        sub = Epochs(self.source, self.starts[idx], self.nsamples, [self.descriptions[i] for i in idx],
+                     self.sampling_rate, self.tmin, self.baseline)
+        if self._offsets is not None:
+            sub._offsets = self._offsets[idx]
+        return sub
+
+    def by_description(self) -> Dict[str, 'Epochs']:
+        return {d: self.select(d) for d in dict.fromkeys(self.descriptions)}
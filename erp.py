@@ -0,0 +1,135 @@
+from typing import List, Callable, Any, Dict, Optional, Tuple
+import threading
+
+import numpy as np
+
+
+class Average:
+    # running mean and variance of epochs (Welford): O(nchannels x nsamples) per trial, no epochs kept
+    def __init__(self, nchannels: int, nsamples: int) -> None:
+        self.n = 0
+        self.mean = np.zeros((nchannels, nsamples))
+        self.m2 = np.zeros((nchannels, nsamples))
+
+    def add(self, epoch: np.ndarray) -> None:
+        self.n += 1
+        d = epoch - self.mean
+        self.mean += d / self.n
+        d *= epoch - self.mean
+        self.m2 += d
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self.m2 / max(1, self.n - 1)
+
+    @property
+    def sem(self) -> np.ndarray:
+        return np.sqrt(self.variance / max(1, self.n))
+
+    def snapshot(self) -> 'Average':
+        a = Average(0, 0)
+        a.n, a.mean, a.m2 = self.n, self.mean.copy(), self.m2.copy()
+        return a
+
+
+# Pipeline consumer: averages epochs around stimulus events per condition while streaming.
+# Blocks go into a ring indexed by board sample index (stamped Blocks); an event is a sample index and a
+# condition, its epoch is cut, baseline corrected (seconds relative to the event, like Epochs) and added
+# once its last sample is in. Subscribers get (condition, Average) after every trial, on the consumer thread
+class ErpStage:
+    def __init__(self, nchannels: int, sampling_rate: float, tmin: float = -0.2, tmax: float = 0.8,
+                 baseline: Optional[Tuple[float, float]] = (-0.2, 0.0), scale: float = 1.0, keep: float = 10.0,
+                 condition: Optional[Callable[[str], str]] = None) -> None:
+        self.nchannels = nchannels
+        self.sampling_rate = sampling_rate
+        self.tmin = tmin
+        self.offset = int(round(tmin * sampling_rate))
+        self.nsamples = int(round((tmax - tmin) * sampling_rate))
+        self.baseline = None  # type: Optional[slice]
+        if baseline is not None:
+            b0 = max(0, int(round((baseline[0] - tmin) * sampling_rate)))
+            b1 = min(self.nsamples, max(b0 + 1, int(round((baseline[1] - tmin) * sampling_rate))))
+            self.baseline = slice(b0, b1)
+        self.scale = scale
+        self.condition = condition or (lambda description: description)  # event description -> condition
+        # events may come in up to `keep` seconds after their epoch has streamed past
+        self.size = self.nsamples + int(keep * sampling_rate)
+        self.ring = np.zeros((nchannels, self.size))
+        self.span = np.arange(self.nsamples)
+        self.last = -1  # board sample index of the newest sample in the ring
+        self.first = 0  # oldest index still in the ring
+        self.pending = [] # type: List[Tuple[int, str]]  # (first sample of the epoch, condition)
+        self.lock = threading.Lock()  # pending and averages: events and snapshots come from other threads
+        self.averages = {} # type: Dict[str, Average]
+        self.subscribers = [] # type: List[Callable[[str, Average], Any]]
+        self.trials = 0
+        self.late = 0  # events whose epoch had already left the ring
+        self.gaps = 0  # samples missing in the stream (epochs over them are averaged anyway)
+
+    def subscribe(self, f: Callable[[str, Average], Any]) -> None:
+        self.subscribers.append(f)
+
+    def event(self, index: int, description: str) -> None:
+        # index: board sample index of the stimulus (Session.stream_offset of its onset times the sampling rate)
+        condition = self.condition(description)
+        with self.lock:
+            self.pending.append((index + self.offset, condition))
+
+    def __call__(self, block: Any) -> Any:
+        arr = np.asarray(block)
+        if arr.ndim == 1:
+            arr = arr[:, np.newaxis]
+        n = arr.shape[1]
+        last = getattr(block, 'index', -1)
+        if last < 0:  # not a stamped block: consecutive samples
+            last = self.last + n
+        if last - n > self.last >= 0:
+            self.gaps += last - n - self.last
+        self.ring[:, (np.arange(last - n + 1, last + 1)) % self.size] = arr
+        self.last = last
+        self.first = max(0, last - self.size + 1)
+        if self.pending:
+            self._average()
+        return block
+
+    def _average(self) -> None:
+        with self.lock:
+            ready = [e for e in self.pending if e[0] + self.nsamples - 1 <= self.last]
+            if not ready:
+                return
+            self.pending = [e for e in self.pending if e[0] + self.nsamples - 1 > self.last]
+        for start, condition in ready:
+            if start < self.first:
+                self.late += 1
+                continue
+            epoch = self.ring[:, (start + self.span) % self.size] * self.scale
+            if self.baseline is not None:
+                epoch -= epoch[:, self.baseline].mean(axis=1, keepdims=True)
+            with self.lock:  # snapshot() must not see n, mean and m2 half updated
+                avg = self.averages.get(condition)
+                if avg is None:
+                    avg = self.averages[condition] = Average(self.nchannels, self.nsamples)
+                avg.add(epoch)
+                self.trials += 1
+            for f in self.subscribers:
+                f(condition, avg)
+
+    @property
+    def times(self) -> np.ndarray:
+        return self.tmin + np.arange(self.nsamples) / self.sampling_rate
+
+    def snapshot(self) -> Dict[str, Average]:
+        # consistent copies, for other threads (plots, shell); subscribers run on the updating thread
+        with self.lock:
+            return {c: a.snapshot() for c, a in self.averages.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            conditions = {c: a.n for c, a in self.averages.items()}
+        return {
+            'trials': self.trials,
+            'conditions': conditions,
+            'pending': len(self.pending),
+            'late': self.late,
+            'gaps': self.gaps,
+        }
@@ -0,0 +1,174 @@
+from typing import List, Callable, Any, Dict, Optional, Sequence, Tuple
+import queue
+from collections import deque
+from threading import Thread
+
+import numpy as np
+
+import timeline
+
+DEFAULT_BANDS = [(4, 8), (8, 13), (13, 30), (30, 45)]  # theta, alpha, beta, low gamma
+
+
+class BandPower:
+    # (nchannels x n) window -> log band power per channel and band, flattened; bands as one matrix product
+    def __init__(self, sampling_rate: int, window: int, bands: Sequence[Tuple[float, float]] = DEFAULT_BANDS) -> None:
+        freqs = np.fft.rfftfreq(window, 1.0 / sampling_rate)
+        self.win = np.hanning(window)
+        self.bands = np.stack([(freqs >= lo) & (freqs < hi) for lo, hi in bands], axis=1).astype(np.float64)
+        self.bands /= np.maximum(1.0, self.bands.sum(axis=0))
+
+    def __call__(self, windows: np.ndarray) -> np.ndarray:
+        # (batch x nchannels x n) -> (batch x nchannels*nbands)
+        spec = np.fft.rfft((windows - windows.mean(axis=2, keepdims=True)) * self.win, axis=2)
+        power = (spec.real**2 + spec.imag**2) @ self.bands
+        return np.log(power + 1e-12).reshape(len(windows), -1)
+
+
+class Raw:
+    # the window itself, flattened; for models trained on epochs
+    def __call__(self, windows: np.ndarray) -> np.ndarray:
+        return windows.reshape(len(windows), -1)
+
+
+class Prediction:
+    def __init__(self, index: int, value: Any, latency: float) -> None:
+        self.index = index  # board sample index (Session.clock) of the last sample in the window
+        self.value = value
+        self.latency = latency  # seconds from that sample's arrival in Session.callback to the prediction
+
+    def __repr__(self) -> str:
+        return 'Prediction({}, {}, {:.1f}ms)'.format(self.index, self.value, self.latency * 1000)
+
+
+# Pipeline consumer: keeps the last `window` samples, cuts a window every `step` samples and
+# hands it to a worker that runs features + model on whatever windows have queued up, as one batch.
+# Takes samples or (nchannels x n) blocks of raw values; windows are multiplied by `scale` for the model.
+# Stamped Blocks give predictions the board sample index and arrival time of their last sample; a sample
+# earlier in a block is taken to have arrived (n-1-j)/sampling_rate before the block's last one
+class InferenceStage:
+    def __init__(self, model: Any, nchannels: int, window: int, step: int, features: Optional[Callable] = None,
+                 budget: float = 0.1, batch: int = 16, maxlen: int = 64, history: int = 1000, scale: float = 1.0,
+                 sampling_rate: Optional[float] = None) -> None:
+        self.predict = model.predict if hasattr(model, 'predict') else model
+        self.features = features or Raw()
+        self.nchannels = nchannels
+        self.window = window
+        self.step = step
+        self.budget = budget
+        self.batch = batch
+        self.scale = scale
+        self.period = 1.0 / sampling_rate if sampling_rate else 0.0
+        self.ring = np.zeros((nchannels, 2 * window))  # each sample written twice, so a window is always contiguous
+        self.pos = 0
+        self.count = 0
+        self.next_end = window  # sample count at which the next window is cut
+        self.pending = queue.Queue(maxlen) # type: queue.Queue
+        self.subscribers = [] # type: List[Callable[[Prediction], Any]]
+        self.latencies = deque(maxlen=history) # type: deque
+        self.predictions = 0
+        self.over_budget = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_error = None # type: Optional[str]
+        self.thread = Thread(target=self._run, name='inference', daemon=True)
+        self.thread.start()
+
+    def subscribe(self, f: Callable[[Prediction], Any]) -> None:
+        self.subscribers.append(f)
+
+    def __call__(self, val: Any) -> Any:
+        arr = np.asarray(val)
+        if arr.ndim == 1:
+            arr = arr[:, np.newaxis]
+        n = arr.shape[1]
+        last = getattr(val, 'index', -1)
+        if last < 0:  # not a stamped block: count samples, time of arrival here
+            last = self.count + n - 1
+        t = getattr(val, 't', -1.0)
+        if t < 0:
+            t = timeline.clock()
+        i = 0
+        while i < n:  # up to the next window end at a time, then cut it before later samples overwrite it
+            m = min(n - i, self.next_end - self.count)
+            self._write(arr[:, i:i + m])
+            i += m
+            if self.count == self.next_end:
+                self.next_end += self.step
+                self._cut(last - (n - i), t - (n - i) * self.period)
+        return val
+
+    def _write(self, chunk: np.ndarray) -> None:
+        # into both halves of the ring, as at most two slices each
+        m = chunk.shape[1]
+        self.count += m
+        if m > self.window:  # step longer than the window: only the last window matters
+            self.pos = (self.pos + m - self.window) % self.window
+            chunk, m = chunk[:, -self.window:], self.window
+        a = min(m, self.window - self.pos)
+        self.ring[:, self.pos:self.pos + a] = chunk[:, :a]
+        self.ring[:, self.pos + self.window:self.pos + self.window + a] = chunk[:, :a]
+        if m > a:
+            self.ring[:, :m - a] = chunk[:, a:]
+            self.ring[:, self.window:self.window + m - a] = chunk[:, a:]
+        self.pos = (self.pos + m) % self.window
+
+    def _cut(self, index: int, t: float) -> None:
+        try:
+            self.pending.put_nowait((index, t, self.ring[:, self.pos:self.pos + self.window].copy()))
+        except queue.Full:  # model can't keep up: skip windows rather than fall behind
+            self.skipped += 1
+
+    def _run(self) -> None:
+        while True:
+            items = [self.pending.get()]
+            if items[0] is None:
+                return
+            while len(items) < self.batch:
+                try:
+                    items.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            stop = items[-1] is None
+            items = [i for i in items if i is not None]
+            try:
+                self._predict(items)
+            except Exception as e:  # a bad batch (e.g. shape mismatch) is counted, the worker keeps going
+                self.errors += 1
+                self.last_error = repr(e)
+            if stop:
+                return
+
+    def _predict(self, items: List[Tuple[int, float, np.ndarray]]) -> None:
+        values = self.predict(self.features(np.stack([w for _, _, w in items]) * self.scale))
+        done = timeline.clock()
+        for (index, t, _), v in zip(items, values):
+            p = Prediction(index, v, done - t)
+            self.latencies.append(p.latency)
+            self.predictions += 1
+            if p.latency > self.budget:
+                self.over_budget += 1
+            for f in self.subscribers:
+                f(p)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        try:
+            self.pending.put(None, timeout=timeout)
+        except queue.Full:  # worker stuck in the model; it is a daemon thread, leave it
+            print('inference worker did not drain its queue in {}s'.format(timeout))
+            return
+        self.thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        lat = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            'predictions': self.predictions,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'over_budget': self.over_budget,
+            'budget_ms': self.budget * 1000,
+            'p50_ms': float(np.percentile(lat, 50)),
+            'p95_ms': float(np.percentile(lat, 95)),
+            'max_ms': float(lat.max()),
+        }
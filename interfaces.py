@@ -1,7 +1,8 @@
-from typing import IO, Any, Type, Callable, TypeVar, Generic
+from typing import IO, Any, Type, Callable, TypeVar, Generic, Optional, Sequence
 T = TypeVar('T')
 
 import multiprocessing as mp
+import sys
 import time
 from queue import Empty
 
@@ -9,18 +10,99 @@ import numpy as np
 
 from topology import get_topology
 import utils
+import metrics
 
 
 class Parameters:
-    def __init__(self, sampling_rate: int, topology_name: str, source: Type['Source']):
+    def __init__(self, sampling_rate: int, topology_name: str, source: Type['Source'], daisy_interpolate: bool = True):
         self.sampling_rate = sampling_rate
         self.topology_name = topology_name
         self.electrode_topology = get_topology(topology_name)
         self.nchannels = len(self.electrode_topology)
         self.Source = source # type: Type['Source']
+        self.daisy_interpolate = daisy_interpolate  # 16 channels: interpolate between paired samples, else hold them
+
+
+# A block of the live stream: an array that also knows the board sample index of its last sample
+# (unwrapped, from the SampleClock) and the timeline.clock() time that sample arrived. Arrays derived
+# from a block (scaled, filtered) keep the stamp.
+class Block(np.ndarray):
+    def __array_finalize__(self, obj: Any) -> None:
+        self.index = getattr(obj, 'index', -1)  # type: int
+        self.t = getattr(obj, 't', -1.0)  # type: float
+
+
+def stamp_block(arr: np.ndarray, index: int, t: float) -> Block:
+    block = arr.view(Block)  # a view: the pooled buffer stays referenced while the block is in use
+    block.index = index
+    block.t = t
+    return block
+
+
+def _probe_refcounts() -> Optional[int]:
+    # Pooled buffers are known to be free from their reference count: every block, slice or other view
+    # downstream (queued, pickled by a feeder thread, kept by a consumer) holds a reference to the buffer.
+    # That is a CPython property, so it is checked once here, with the exact expression _next_buffer uses:
+    # -> the count of a free pooled buffer, or None where views don't show up in it (reuse is then off)
+    if sys.implementation.name != 'cpython' or not hasattr(sys, 'getrefcount'):
+        return None
+    pool = [np.empty((2, 4), dtype=np.int32)]
+    free = sys.getrefcount(pool[0])
+    view = stamp_block(pool[0][:, :2], 0, 0.0)
+    held = sys.getrefcount(pool[0]) > free
+    del view
+    return free if held and sys.getrefcount(pool[0]) == free else None
+
+
+FREE_REFS = _probe_refcounts()
+
+
+# First stage of the live chain: raw integer samples are copied into (nchannels x length) int32 blocks;
+# a full block is passed on, a partial one yields None. Blocks come from a small pool and a buffer is only
+# written again once nothing downstream holds it any more (see _probe_refcounts), so steady streaming
+# allocates nothing; where that can't be told, every block gets a new buffer.
+class BlockAssembler:
+    lag = 0  # input samples between the last sample of the returned block and the newest input
+
+    def __init__(self, nchannels: int, length: int, channels: Optional[Callable[[Any], Sequence[int]]] = None, pool: int = 8) -> None:
+        self.length = length
+        self.channels = channels
+        self.pool = [np.empty((nchannels, length), dtype=np.int32) for _ in range(pool)]
+        self.i = 0
+        self.k = 0  # samples in the current block
+        self.cur = self.pool[0]
+        self.allocated = 0  # buffers replaced because every pooled one was still in use (or reuse is off)
+
+    def _next_buffer(self) -> np.ndarray:
+        for _ in range(len(self.pool) if FREE_REFS is not None else 0):
+            self.i = (self.i + 1) % len(self.pool)
+            if sys.getrefcount(self.pool[self.i]) == FREE_REFS:  # only the pool holds it
+                return self.pool[self.i]
+        self.pool[self.i] = np.empty_like(self.cur)
+        self.allocated += 1
+        return self.pool[self.i]
+
+    def __call__(self, sample: Any) -> Optional[np.ndarray]:
+        if self.k == 0:
+            self.cur = self._next_buffer()
+        self.cur[:, self.k] = self.channels(sample) if self.channels else sample
+        self.k += 1
+        if self.k < self.length:
+            return None
+        self.k = 0
+        return self.cur
+
+    def flush(self) -> Optional[np.ndarray]:
+        # the partial block, e.g. when the stream stops; None if there is none
+        if self.k == 0:
+            return None
+        k, self.k = self.k, 0
+        return self.cur[:, :k]
 
 
 class Source(Generic[T]):
+    scale = 1.0  # microvolts per unit of the raw values carried by the live pipeline
+
     @classmethod
     def setup(self, params: Parameters, port: str) -> T:
         raise NotImplemented
@@ -29,6 +111,15 @@ class Source(Generic[T]):
     def default_callback(self, sample: Any) -> np.ndarray:
         raise NotImplemented
 
+    @classmethod
+    def raw_channels(self, sample: Any) -> Sequence[int]:
+        raise NotImplemented
+
+    @classmethod
+    def block_callback(self, params: Parameters) -> BlockAssembler:
+        # ~20ms blocks: per-sample work is one copy into a buffer, everything downstream runs per block
+        return BlockAssembler(params.nchannels, max(1, params.sampling_rate // 50), self.raw_channels)
+
     @classmethod
     def sample_to_csv(self, out: IO, sample: Any) -> None:
         raise NotImplemented
@@ -55,16 +146,22 @@ class SubprocessInterface:
     def __init__(self, Class: Type, params: Parameters):
         self.queue = mp.Queue(100)  # type: ignore
         self.should_run = mp.Value('b', True)
+        self.consumed = mp.Value('L', 0, lock=False)  # only the child writes it
+        labels = {'process': Class.__name__}
+        self.m_sent = metrics.REGISTRY.counter('bci_subprocess_sent_total', 'blocks queued to a subprocess', labels)
+        self.m_dropped = metrics.REGISTRY.counter('bci_subprocess_dropped_total', 'blocks dropped, subprocess queue full', labels)
+        metrics.REGISTRY.gauge('bci_subprocess_consumed', 'blocks the subprocess has consumed (GUI frames)', labels, f=lambda: self.consumed.value)
         # self.period = utils.period_function(1.0, lambda: print(self.queue.qsize()))
-        self.process = mp.Process(target=self._run, args=(Class, params, self.queue, self.should_run,))
+        self.process = mp.Process(target=self._run, args=(Class, params, self.queue, self.should_run, self.consumed,))
         self.process.start()
 
-    def _run(self, Class: Type, params: Parameters, queue: mp.Queue, should_run: mp.Value) -> None:
+    def _run(self, Class: Type, params: Parameters, queue: mp.Queue, should_run: mp.Value, consumed: mp.Value) -> None:
         kwargs = Class.get_params(params)
         instance = Class(**kwargs)
         while should_run.value:
             try:
                 instance.consume(queue.get(block=False))
+                consumed.value += 1
             except Empty:
                 time.sleep(0.1)
         instance.stop()
@@ -73,6 +170,9 @@ class SubprocessInterface:
         # self.period()
         if not self.queue.full():
             self.queue.put(val)
+            self.m_sent.inc()
+        else:
+            self.m_dropped.inc()
 
     def stop(self) -> None:
         self.should_run.value = False
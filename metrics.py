@@ -0,0 +1,259 @@
+from typing import List, Callable, Any, Dict, Optional, Tuple, Iterator, Sequence
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Labels are a sorted tuple of (name, value) pairs, so one metric name can have several series
+Labels = Tuple[Tuple[str, str], ...]
+# (name, type, help, labels, value) as produced at scrape time by collectors
+Sample = Tuple[str, str, str, Dict[str, str], float]
+
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+_cells_lock = threading.Lock()  # taken once per writing thread and metric, never on an update
+
+
+class Counter:
+    # Monotonic count. Every writing thread adds to a cell of its own, so inc() is one list item
+    # update with no lock; readers sum the cells (a scrape may miss an increment in flight)
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.cells = [] # type: List[List[float]]
+        self.local = threading.local()
+
+    def inc(self, n: float = 1) -> None:
+        try:
+            self.local.cell[0] += n
+        except AttributeError:
+            cell = self.local.cell = [n]
+            with _cells_lock:
+                self.cells = self.cells + [cell]
+
+    def value(self) -> float:
+        return sum(c[0] for c in self.cells)
+
+
+class Gauge:
+    # Current value: set() by its owner, or read from `f` at scrape time (nothing on the hot path)
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Labels = (), f: Optional[Callable[[], float]] = None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.f = f
+        self.current = 0.0
+
+    def set(self, v: float) -> None:
+        self.current = v
+
+    def value(self) -> float:
+        return float(self.f()) if self.f is not None else self.current
+
+
+class Histogram:
+    # Fixed buckets; like Counter, one cell (bucket counts, sum) per writing thread
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Labels = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = list(buckets)
+        self.cells = [] # type: List[List[Any]]
+        self.local = threading.local()
+
+    def observe(self, v: float) -> None:
+        try:
+            cell = self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [[0] * (len(self.bounds) + 1), 0.0]
+            with _cells_lock:
+                self.cells = self.cells + [cell]
+        cell[0][bisect_left(self.bounds, v)] += 1
+        cell[1] += v
+
+    def value(self) -> Tuple[List[int], float]:
+        # (non-cumulative counts per bucket with +Inf last, sum)
+        counts = [0] * (len(self.bounds) + 1)
+        total = 0.0
+        for c in self.cells:
+            for i, k in enumerate(c[0]):
+                counts[i] += k
+            total += c[1]
+        return counts, total
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(labels: Any, extra: str = '') -> str:
+    items = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in (labels.items() if isinstance(labels, dict) else labels)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = {} # type: Dict[Tuple[str, Labels], Any]
+        self.collectors = {} # type: Dict[str, Callable[[], Iterator[Sample]]]
+        self.lock = threading.Lock()
+
+    def _get(self, cls: type, name: str, help: str, labels: Dict[str, str], **kwargs: Any) -> Any:
+        key = (name, _labels(labels))
+        with self.lock:
+            if key not in self.metrics:
+                self.metrics[key] = cls(name, help, key[1], **kwargs)
+            m = self.metrics[key]
+        if not isinstance(m, cls):
+            raise Exception('Metric {} already registered as a {}'.format(name, m.kind))
+        return m
+
+    # get-or-create; keep the returned object, lookups are for setup, not for every update
+    def counter(self, name: str, help: str = '', labels: Dict[str, str] = {}) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = '', labels: Dict[str, str] = {}, f: Optional[Callable[[], float]] = None) -> Gauge:
+        g = self._get(Gauge, name, help, labels)
+        if f is not None:
+            g.f = f
+        return g
+
+    def histogram(self, name: str, help: str = '', labels: Dict[str, str] = {}, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def collector(self, key: str, f: Optional[Callable[[], Iterator[Sample]]]) -> None:
+        # scrape-time source of samples for state that lives elsewhere (queues, clocks); None removes it
+        with self.lock:
+            if f is None:
+                self.collectors.pop(key, None)
+            else:
+                self.collectors[key] = f
+
+    def collect(self) -> List[Sample]:
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors.values())
+        out = [] # type: List[Sample]
+        for m in metrics:
+            out.append((m.name, m.kind, m.help, dict(m.labels), m.value()))
+        for f in collectors:
+            try:
+                out.extend(f())
+            except Exception as e:
+                print('metrics collector failed: {}'.format(e))
+        return out
+
+    def render_prometheus(self) -> str:
+        lines = [] # type: List[str]
+        described = set()
+        for name, kind, help, labels, value in sorted(self.collect(), key=lambda s: s[0]):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, help or name))
+                lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'histogram':
+                counts, total = value
+                bounds = self._bounds(name, labels)
+                cum = 0
+                for b, k in zip(bounds + [float('inf')], counts):
+                    cum += k
+                    lines.append('{}_bucket{} {}'.format(name, _fmt_labels(labels, 'le="{}"'.format('+Inf' if b == float('inf') else repr(b))), cum))
+                lines.append('{}_sum{} {}'.format(name, _fmt_labels(labels), repr(total)))
+                lines.append('{}_count{} {}'.format(name, _fmt_labels(labels), cum))
+            else:
+                lines.append('{}{} {}'.format(name, _fmt_labels(labels), repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def _bounds(self, name: str, labels: Dict[str, str]) -> List[float]:
+        m = self.metrics.get((name, _labels(labels)))
+        return m.bounds if m is not None else LATENCY_BUCKETS
+
+    def snapshot(self) -> Dict[str, Any]:
+        # flat {name{labels}: value}; histograms as {count, sum, buckets: {le: cumulative count}}
+        snap = {} # type: Dict[str, Any]
+        for name, kind, _, labels, value in self.collect():
+            key = name + _fmt_labels(labels)
+            if kind == 'histogram':
+                counts, total = value
+                cum = 0
+                buckets = {}
+                for b, k in zip(self._bounds(name, labels) + [float('inf')], counts):
+                    cum += k
+                    buckets['+Inf' if b == float('inf') else repr(b)] = cum
+                snap[key] = {'count': cum, 'sum': total, 'buckets': buckets}
+            else:
+                snap[key] = value
+        return snap
+
+
+REGISTRY = Registry()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: Any) -> None:
+        pass  # scrapes every few seconds would flood the shell
+
+
+# Prometheus text endpoint, http://<host>:<port>/metrics, served from its own threads
+class MetricsServer:
+    def __init__(self, port: int = 9108, host: str = '127.0.0.1', registry: Registry = REGISTRY) -> None:
+        handler = type('Handler', (_Handler,), {'registry': registry})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.address = '{}:{}'.format(host, self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Appends {"t": unix time, "metrics": snapshot} to a file every `period` seconds, and once more on stop
+class JsonLinesExporter:
+    def __init__(self, fname: str, period: float = 10.0, registry: Registry = REGISTRY) -> None:
+        self.fname = fname
+        self.period = period
+        self.registry = registry
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='metrics-jsonl', daemon=True)
+        self.thread.start()
+
+    def write(self) -> None:
+        line = json.dumps({'t': time.time(), 'metrics': self.registry.snapshot()})
+        with open(self.fname, 'a') as out:
+            out.write(line + '\n')
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.period):
+            try:
+                self.write()
+            except Exception as e:
+                print('metrics: cannot write {}: {}'.format(self.fname, e))
+        self.write()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
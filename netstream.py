@@ -0,0 +1,166 @@
+from typing import List, Tuple, Any, Optional
+import os
+import queue
+import socket
+import struct
+from threading import Thread, Lock
+
+import numpy as np
+
+import timeline
+
+# Frame: header, then the raw C-ordered array buffer (rows*cols items of dtype)
+# magic, sequence number, timeline.clock() timestamp, numpy dtype char, rows, cols
+HEADER = struct.Struct('<4sQdcII')
+MAGIC = b'BCI1'
+
+
+def parse_address(address: str) -> Tuple[int, Any]:
+    # 'unix:/path/to.sock' or 'tcp:host:port' / 'host:port'
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[5:]
+    if address.startswith('tcp:'):
+        address = address[4:]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def send_all(sock: socket.socket, bufs: List[memoryview]) -> None:
+    # sendmsg gathers header and array without concatenating them; finish partial writes by hand
+    sent = sock.sendmsg(bufs)
+    for b in bufs:
+        if sent >= len(b):
+            sent -= len(b)
+            continue
+        sock.sendall(b[sent:])
+        sent = 0
+
+
+class Subscription:
+    def __init__(self, sock: socket.socket, maxlen: int) -> None:
+        self.sock = sock
+        self.frames = queue.Queue(maxlen) # type: queue.Queue
+        self.dropped = 0
+        self.sent = 0
+        self.alive = True
+        self.thread = Thread(target=self._run, name='netstream-subscriber', daemon=True)
+        self.thread.start()
+
+    def offer(self, frame: Tuple[bytes, memoryview]) -> None:
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:  # slow subscriber: drop for it only
+            self.dropped += 1
+
+    def _run(self) -> None:
+        try:
+            for header, payload in iter(self.frames.get, None):
+                send_all(self.sock, [memoryview(header), payload])
+                self.sent += 1
+        except OSError:
+            pass
+        self.alive = False
+        self.sock.close()
+
+    def close(self) -> None:
+        self.alive = False
+        try:
+            self.frames.put_nowait(None)
+        except queue.Full:
+            self.sock.close()  # sender fails out of its blocking send
+
+
+# Publishes every value passed to `callback` to all connected subscribers; usable as a callback_seq stage
+class Publisher:
+    def __init__(self, address: str, maxlen: int = 1024) -> None:
+        self.address = address
+        self.maxlen = maxlen
+        self.seq = 0
+        self.subscribers = [] # type: List[Subscription]
+        self.lock = Lock()
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(addr)
+        self.server.listen()
+        self.running = True
+        Thread(target=self._accept, name='netstream-accept', daemon=True).start()
+
+    def _accept(self) -> None:
+        while self.running:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.subscribers.append(Subscription(sock, self.maxlen))
+
+    def publish(self, arr: np.ndarray, t: Optional[float] = None) -> None:
+        arr = np.ascontiguousarray(arr)
+        rows, cols = (arr.shape[0], 1) if arr.ndim == 1 else arr.shape
+        header = HEADER.pack(MAGIC, self.seq, timeline.clock() if t is None else t, arr.dtype.char.encode(), rows, cols)
+        payload = memoryview(arr).cast('B')
+        self.seq += 1
+        with self.lock:
+            subs = self.subscribers = [s for s in self.subscribers if s.alive]
+        for s in subs:
+            s.offer((header, payload))
+
+    def callback(self, vec: Any) -> Any:
+        self.publish(np.asarray(vec), getattr(vec, 't', None))  # live blocks carry their arrival time
+        return vec
+
+    def stop(self) -> None:
+        self.running = False
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)  # wakes up accept()
+        except OSError:
+            pass
+        self.server.close()
+        with self.lock:
+            for s in self.subscribers:
+                s.close()
+            self.subscribers = []
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+
+class Subscriber:
+    def __init__(self, address: str) -> None:
+        family, addr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self.header = bytearray(HEADER.size)
+
+    def _recv_into(self, buf: Any) -> None:
+        view = memoryview(buf).cast('B')
+        while len(view) > 0:
+            n = self.sock.recv_into(view)
+            if n == 0:
+                raise EOFError('Publisher closed the stream')
+            view = view[n:]
+
+    def recv(self) -> Tuple[int, float, np.ndarray]:
+        self._recv_into(self.header)
+        magic, seq, t, dtype, rows, cols = HEADER.unpack(self.header)
+        if magic != MAGIC:
+            raise Exception('Bad frame magic: {!r}'.format(magic))
+        arr = np.empty((rows, cols), dtype=np.dtype(dtype.decode()))
+        self._recv_into(arr)
+        return seq, t, arr
+
+    def __iter__(self) -> Any:
+        while True:
+            try:
+                yield self.recv()
+            except EOFError:
+                return
+
+    def close(self) -> None:
+        self.sock.close()
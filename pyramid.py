@@ -0,0 +1,144 @@
+from typing import List, Optional, Tuple, Any
+import os
+
+import numpy as np
+
+import tfr
+
+CACHE_DIR = tfr.CACHE_DIR
+BASE_BIN = 64  # samples per bin of the finest level; finer views are reduced from the data on the fly
+FACTOR = 8  # bins of a level per bin of the next, coarser one
+MIN_BINS = 1024  # stop once a level is this coarse
+CHUNK = 1 << 20  # samples per channel reduced at a time when building the finest level
+
+
+def reduce_minmax(lo: np.ndarray, hi: np.ndarray, size: int) -> np.ndarray:
+    # (nch x n) lows/highs -> (nch x ceil(n/size) x 2) float32 [min, max] per bin of `size`
+    nch, n = lo.shape
+    full = n // size
+    out = np.empty((nch, -(-n // size), 2), dtype=np.float32)
+    if full:
+        out[:, :full, 0] = lo[:, :full * size].reshape(nch, full, size).min(axis=2)
+        out[:, :full, 1] = hi[:, :full * size].reshape(nch, full, size).max(axis=2)
+    if n > full * size:
+        out[:, full, 0] = lo[:, full * size:].min(axis=1)
+        out[:, full, 1] = hi[:, full * size:].max(axis=1)
+    return out
+
+
+def level_count(n: int) -> int:
+    bins, k = -(-n // BASE_BIN), 1
+    while bins > MIN_BINS:
+        bins, k = -(-bins // FACTOR), k + 1
+    return k
+
+
+def build_level(src: np.ndarray, size: int, out: np.ndarray) -> None:
+    # src: raw (nch x n) data or the previous level (nch x nbins x 2); chunked so temporaries stay small
+    step = CHUNK - CHUNK % size
+    for i in range(0, src.shape[1], step):
+        part = src[:, i:i + step]
+        if part.ndim == 2:
+            env = reduce_minmax(part, part, size)
+        else:
+            env = reduce_minmax(part[:, :, 0], part[:, :, 1], size)
+        out[:, i // size:i // size + env.shape[1]] = env
+
+
+# Per-channel min/max envelopes at BASE_BIN, BASE_BIN*FACTOR, ... samples per bin: any time span is
+# drawn from about as many bins as there are pixels, whatever the recording length
+class Pyramid:
+    def __init__(self, data: np.ndarray, levels: List[np.ndarray], sampling_rate: float, ch_names: List[str]) -> None:
+        self.data = data
+        self.levels = levels  # levels[k]: (nch x nbins x 2) float32, BASE_BIN * FACTOR**k samples per bin
+        self.sampling_rate = sampling_rate
+        self.ch_names = ch_names
+
+    @property
+    def duration(self) -> float:
+        return self.data.shape[1] / self.sampling_rate
+
+    def envelope(self, tmin: float, tmax: float, width: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # -> (bin start times, lows, highs) covering [tmin, tmax): the coarsest stored level that still has
+        # a bin per pixel (width to FACTOR*width bins), or bins reduced from the data when zoomed in further
+        n = self.data.shape[1]
+        i0 = min(n, max(0, int(tmin * self.sampling_rate)))
+        i1 = min(n, max(i0 + 1, int(np.ceil(tmax * self.sampling_rate))))
+        per_px = max(1, (i1 - i0) // max(1, width))
+        size = BASE_BIN
+        level = -1
+        while level + 1 < len(self.levels) and size <= per_px:
+            level += 1
+            size *= FACTOR
+        if level < 0:
+            size = per_px
+            env = reduce_minmax(self.data[:, i0:i1], self.data[:, i0:i1], size)
+            b0 = i0
+        else:
+            size //= FACTOR
+            b0, b1 = i0 // size, -(-i1 // size)
+            env = self.levels[level][:, b0:b1]
+            b0 *= size
+        times = (b0 + np.arange(env.shape[1]) * size) / self.sampling_rate
+        return times, env[:, :, 0], env[:, :, 1]
+
+
+def pyramid(data: np.ndarray, sampling_rate: float, ch_names: List[str], ident: dict,
+            cache_dir: str = CACHE_DIR) -> Pyramid:
+    # cached next to the spectrograms, one memory-mapped .npy per level; a cache hit reads nothing up front
+    nch, n = data.shape
+    key = tfr.cache_key(dict(ident, base=BASE_BIN, factor=FACTOR, shape=[nch, n]))
+    names = [os.path.join(cache_dir, 'pyr_{}_{}.npy'.format(key, k)) for k in range(level_count(n))]
+    if not os.path.exists(names[-1]):  # levels are renamed into place finest first
+        os.makedirs(cache_dir, exist_ok=True)
+        src, size = data, BASE_BIN  # type: Any, int
+        for fname in names:
+            tmp = fname + '.part.npy'
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(nch, -(-src.shape[1] // size), 2))
+            build_level(src, size, out)
+            out.flush()
+            del out
+            os.replace(tmp, fname)
+            src, size = np.load(fname, mmap_mode='r'), FACTOR
+    return Pyramid(data, [np.load(f, mmap_mode='r') for f in names], sampling_rate, ch_names)
+
+
+def view(pyr: Pyramid, annotations: Optional[dict] = None, tmin: float = 0.0, duration: Optional[float] = None) -> None:
+    # stacked channels drawn as min/max strokes; panning or zooming redraws only the visible span at screen resolution
+    import matplotlib.pyplot as plt
+
+    top = pyr.levels[-1]
+    lo, hi = np.percentile(top[:, :, 0], 1, axis=1), np.percentile(top[:, :, 1], 99, axis=1)
+    centre, span = (lo + hi) / 2, np.maximum(hi - lo, 1e-12)
+    offsets = np.arange(len(pyr.ch_names))[::-1].astype(np.float64)
+
+    fig, ax = plt.subplots()
+    lines = [ax.plot([], [], lw=0.6)[0] for _ in pyr.ch_names]
+    ax.set_yticks(offsets)
+    ax.set_yticklabels(pyr.ch_names)
+    ax.set_ylim(-1, len(pyr.ch_names))
+    ax.set_xlabel('s')
+    if annotations and annotations.get('onset'):
+        ax.vlines(annotations['onset'], -1, len(pyr.ch_names), colors='grey', lw=0.5, alpha=0.5)
+    drawn = [None]  # type: List[Any]
+
+    def redraw(ax: Any) -> None:
+        t0, t1 = ax.get_xlim()
+        width = int(ax.bbox.width)
+        if drawn[0] == (t0, t1, width):
+            return
+        drawn[0] = (t0, t1, width)
+        times, lows, highs = pyr.envelope(t0, t1, width)
+        x = np.repeat(times, 2)
+        for i, line in enumerate(lines):
+            y = np.empty(2 * len(times))
+            y[0::2] = lows[i]
+            y[1::2] = highs[i]
+            line.set_data(x, (y - centre[i]) / span[i] + offsets[i])
+        fig.canvas.draw_idle()
+
+    ax.callbacks.connect('xlim_changed', redraw)
+    fig.canvas.mpl_connect('resize_event', lambda _: redraw(ax))
+    ax.set_xlim(tmin, tmin + (duration if duration else pyr.duration))
+    redraw(ax)
+    plt.show()
@@ -4,22 +4,34 @@ TFun = TypeVar('TFun', bound=Callable[..., Any])
 Args = List[str]
 
 from multiprocessing import Process
+import multiprocessing as mp
 import os
 import random
 import sys
 import time
 import traceback
-from threading import Thread
+import numpy as np
 from collections import namedtuple
 
 from base import Session
-from interfaces import SubprocessInterface
+from interfaces import Parameters, SubprocessInterface
 from tkinter_gui import TkInterGui
+from tasks import TaskManager
+import tasks
+import timeline
 import utils
+import metrics
 
 Cmd = namedtuple('Cmd', ['func', 'help'])
 G_cmds = {} # type: Dict[str, Cmd]
-G_threads = [] # type: List[Thread]
+G_tasks = TaskManager()
+G_publishers = [] # type: List[Any]
+G_recorders = [] # type: List[Any]
+G_metrics = [] # type: List[Any]
+G_display_rate = 250
+G_classifier = None # type: Any
+G_erp = None # type: Any
+G_connectivity = None # type: Any
 
 
 class ArgError(Exception):
@@ -64,14 +76,20 @@ class defcmd:
         return cast(TFun, wrap)
 
 
-def in_thread(f: T) -> T:
+def in_task(f: T, dedicated: bool = False) -> T:
+    # run the command in the background task pool; see 'jobs' and 'kill'
     def wrap(*args: Any) -> None:
-        t = Thread(target=f, args=tuple(args), name=f.__name__) # type: ignore
-        t.start()
-        G_threads.append(t)
+        name = f.__name__[4:] if f.__name__.startswith('cmd_') else f.__name__ # type: ignore
+        task = G_tasks.submit(name, f, *args, dedicated=dedicated)
+        print('[{}] {}'.format(task.id, name))
     return cast(T, wrap)
 
 
+def in_acquisition_task(f: T) -> T:
+    # like in_task, on a thread of its own: a stream starts now, never queued behind other jobs
+    return in_task(f, dedicated=True)
+
+
 ## COMMANDS ###
 
 @defcmd('e', '<expr># - evaluate string as a code')
@@ -82,10 +100,18 @@ def cmd_eval(ssn: Session, *s: str) -> None:
 
 @defcmd(['exit', 'q'], '# - stop everything and exit repl')
 def cmd_exit(ssn: Session) -> None:
-    utils.should_run = False
+    G_tasks.cancel_all()
+    if not G_tasks.join(5.0):
+        print('Some tasks did not stop: {}'.format(', '.join(str(t) for t in G_tasks.active())))
     cmd_sstop(ssn) #  stop stream just in case
     if ssn.gui:
         ssn.gui.stop()
+    cmd_publish(ssn, 'stop')
+    ssn.stop_consumers()  # drain consumers before recorders close
+    for r in G_recorders:
+        r.close()
+    cmd_metrics(ssn, 'stop')  # after everything else, so the last JSON line has the final counts
+    tasks.request_shutdown()
 
 
 @defcmd(['help', 'h'], '[cmd]# - show help')
@@ -104,17 +130,20 @@ def cmd_help(ssn: Session, cmd_name: str = None) -> None:
 def cmd_sleep(ssn: Session, duration: float) -> None:
     time.sleep(float(duration))
 
-@defcmd('gui', '<start|stop># - start/stop GUI; default: start')
-def cmd_gui(ssn: Session, action: str = 'start') -> None:
+@defcmd('gui', '<start|stop> [rate]# - start/stop GUI; default: start, at min(sampling rate, 250)')
+def cmd_gui(ssn: Session, action: str = 'start', rate: Optional[str] = None) -> None:
     if ssn.gui is not None and action == 'start':
         raise Exception('GUI already runnng')
     elif ssn.gui is not None and action == 'stop':
+        ssn.remove_callback(ssn.gui.callback)
         ssn.gui.stop()
         ssn.gui = None
     elif ssn.gui is None and action == 'start':
-        gui = SubprocessInterface(TkInterGui, ssn.params)
+        display_rate = int(rate) if rate else min(ssn.params.sampling_rate, G_display_rate)
+        params = Parameters(sampling_rate=display_rate, topology_name=ssn.params.topology_name, source=ssn.params.Source)
+        gui = SubprocessInterface(TkInterGui, params)
         ssn.gui = gui
-        ssn.add_callback(gui.callback)
+        ssn.add_callback(gui.callback, name='gui', overflow='drop_oldest', rate=display_rate)
     elif ssn.gui is None and action == 'stop':
         raise Exception('No GUI to stop')
     else:
@@ -122,14 +151,14 @@ def cmd_gui(ssn: Session, action: str = 'start') -> None:
 
 
 @defcmd('csv', '<csv># - replay preprocessed csv file')
-@in_thread
+@in_task
 def cmd_csv(ssn: Session, fname: str) -> None:
     import csv
     with open(fname, 'r') as inp:
         for l in csv.reader(inp):
-            if not utils.should_run:
+            if not tasks.should_run():
                 break
-            ssn.callback(list(map(float,l)))
+            ssn.callback(np.rint(np.array(list(map(float,l))) / ssn.params.Source.scale))  # back to raw counts
             time.sleep(1.0/ssn.params.sampling_rate) # TODO: save srate in file
 
 
@@ -143,13 +172,60 @@ def cmd_import(ssn: Session, fname: Optional[str] = None) -> None:
     ssn.import_data(fname)
 
 
+@defcmd('spatial', '<live|data> <car|laplacian|bipolar|off> [pairs]# - re-reference stream or imported data (a new filter replaces the previous one); pairs for bipolar: FZ-CZ,P3-PZ')
+def cmd_spatial(ssn: Session, target: str, kind: str, pairs: str = '') -> None:
+    from spatial import parse_pairs
+
+    if kind == 'bipolar' and not pairs:
+        raise ArgError('bipolar montage needs pairs')
+    if target == 'live':
+        ssn.set_spatial_filter(None if kind == 'off' else kind, parse_pairs(pairs))
+    elif target == 'data':
+        ssn.spatial_filter_data(None if kind == 'off' else kind, parse_pairs(pairs))
+    else:
+        raise ArgError('expected live|data')
+
+
 @defcmd('save_session', '[fname]# - save session')
 def cmd_save_session(ssn: Session, fname: Optional[str] = None) -> None:
     ssn.save(fname)
 
-@defcmd('plot', '# - display session graph')
-def cmd_plot_session(ssn: Session) -> None:
-    if ssn.data:
+@defcmd('catalog', '<scan|find> [name=glob] [topology=t] [since=date] [until=date] [desc=glob]# - index saved sessions; find sessions and annotation time ranges without loading them (date: YYYY-MM-DD[-HH:MM:SS])')
+def cmd_catalog(ssn: Session, action: str, *filters: str) -> None:
+    import catalog
+
+    cat = catalog.Catalog()
+    if action == 'scan':
+        t0 = time.time()
+        print('Indexed {}, removed {} ({:.2f}s)'.format(*cat.scan(), time.time() - t0))
+    elif action == 'find':
+        kw = {} # type: Dict[str, Any]
+        for f in filters:
+            k, _, v = f.partition('=')
+            if k in ('since', 'until'):
+                kw[k] = catalog.parse_time(v)
+            elif k in ('name', 'topology'):
+                kw[k] = v
+            elif k == 'desc':
+                kw['description'] = v
+            else:
+                raise ArgError('unknown filter {}'.format(f))
+        t0 = time.time()
+        found = cat.query(**kw)
+        for m in found:
+            print('{} {} ({} - {}, {}, {}Hz)'.format(m.path, m.name, ssn._strtime(m.tstart), ssn._strtime(m.tstop), m.topology, m.sampling_rate))
+            for onset, end, desc in m.ranges:
+                print('  {:10.3f} - {:10.3f}  {}'.format(onset, end, desc))
+        print('{} sessions ({:.1f}ms)'.format(len(found), (time.time() - t0) * 1000))
+    else:
+        raise ArgError('expected scan|find')
+
+
+@defcmd('plot', '[tmin|mne] [duration]# - browse session data at screen resolution (min/max pyramid, cached); mne - whole session in the MNE browser')
+def cmd_plot_session(ssn: Session, tmin: str = '0', duration: Optional[str] = None) -> None:
+    if not ssn.data:
+        return
+    if tmin == 'mne':
         ssn.data.plot(
             n_channels = ssn.params.nchannels,
             duration=ssn.tstop - ssn.tstart,
@@ -157,14 +233,203 @@ def cmd_plot_session(ssn: Session) -> None:
             block=True,
             scalings = 'auto'
         )
-
-
-@defcmd('record_local', '<file># - open a new file to save data to; need to close shell to flush')
+    else:
+        import pyramid
+        t0 = time.time()
+        pyr = ssn.pyramid()
+        print('Pyramid: {} levels ({:.2f}s)'.format(len(pyr.levels), time.time() - t0))
+        pyramid.view(pyr, ssn.annotations, float(tmin), float(duration) if duration else None)
+
+
+@defcmd('spectrogram', '[window] [overlap] [channel] [tmin] [tmax]# - time-frequency power of imported data (cached); plots a channel if given')
+def cmd_spectrogram(ssn: Session, window: str = '2', overlap: str = '0.5', channel: Optional[str] = None,
+                    tmin: str = '0', tmax: Optional[str] = None) -> None:
+    t0 = time.time()
+    spec = ssn.spectrogram(float(window), float(overlap))
+    print('Spectrogram: {} channels x {} frames x {} freqs ({:.2f}s)'.format(*spec.power.shape, time.time() - t0))
+    if channel is not None:
+        import matplotlib.pyplot as plt
+        ch = int(channel) if channel.isdigit() else channel
+        power, times, freqs = spec.slice(float(tmin), float(tmax) if tmax else None, [ch])
+        plt.pcolormesh(times, freqs, 10 * np.log10(power[0].T + 1e-20), shading='auto')
+        plt.xlabel('s')
+        plt.ylabel('Hz')
+        plt.title(str(ch))
+        plt.show()
+
+
+@defcmd('classify', '<model.pkl|stop|stats> [window_s] [step_s] [budget_ms] [bandpower|raw]# - live predictions from a pickled model (predict(X) or callable)')
+def cmd_classify(ssn: Session, model: str, window: str = '1', step: str = '0.25', budget: str = '100', features: str = 'bandpower') -> None:
+    global G_classifier
+    import pickle
+    from inference import InferenceStage, BandPower, Raw
+
+    if model == 'stats':
+        if G_classifier:
+            print(G_classifier.stats())
+        return
+    if G_classifier is not None:
+        ssn.remove_callback(G_classifier)
+        G_classifier.stop()
+        print(G_classifier.stats())
+        G_classifier = None
+    if model == 'stop':
+        return
+
+    with open(model, 'rb') as inp:
+        m = pickle.load(inp)
+    sr = ssn.params.sampling_rate
+    nwin = int(float(window) * sr)
+    feats = BandPower(sr, nwin) if features == 'bandpower' else Raw()
+    stage = InferenceStage(m, ssn.params.nchannels, nwin, max(1, int(float(step) * sr)), feats, float(budget) / 1000,
+                           scale=ssn.params.Source.scale, sampling_rate=sr)
+    last = [None] # type: List[Any]
+    def show(p: Any) -> None:
+        if p.value != last[0]:
+            print('prediction @{}: {}'.format(p.index, p.value))
+            last[0] = p.value
+    stage.subscribe(show)
+    ssn.add_callback(stage, name='classify', maxlen=1 << 16, overflow='block')  # windows need every sample
+    G_classifier = stage
+
+
+@defcmd('erp', '<start|stop|stats|show> [tmin_s] [tmax_s] [separator]|[condition] [channel]# - live per-condition averages of epochs around slideshow onsets; separator: condition is the image name up to it')
+def cmd_erp(ssn: Session, action: str, *args: str) -> None:
+    global G_erp
+    from erp import ErpStage
+
+    if action == 'stats':
+        if G_erp:
+            print(G_erp.stats())
+        return
+    if action == 'show':
+        if G_erp is None:
+            raise ArgError('erp is not running')
+        import matplotlib.pyplot as plt
+
+        averages = G_erp.snapshot()
+        conditions = [args[0]] if args and args[0] != '*' else sorted(averages)
+        channel = args[1] if len(args) > 1 else ssn.params.electrode_topology[0]
+        if channel not in ssn.params.electrode_topology:
+            raise ArgError('unknown channel {}'.format(channel))
+        ch = ssn.params.electrode_topology.index(channel)
+        for c in conditions:
+            if c not in averages:
+                raise ArgError('no trials for {}'.format(c))
+            a = averages[c]
+            plt.plot(G_erp.times, a.mean[ch], label='{} (n={})'.format(c, a.n))
+            plt.fill_between(G_erp.times, a.mean[ch] - a.sem[ch], a.mean[ch] + a.sem[ch], alpha=0.3)
+        plt.axvline(0, color='grey', lw=0.5)
+        plt.xlabel('s')
+        plt.ylabel('uV')
+        plt.title(channel)
+        plt.legend()
+        plt.show()
+        return
+    if G_erp is not None:
+        ssn.remove_callback(G_erp)
+        print(G_erp.stats())
+        G_erp = None
+    if action == 'stop':
+        return
+    if action != 'start':
+        raise ArgError('expected start, stop, stats or show')
+
+    tmin = float(args[0]) if len(args) > 0 else -0.2
+    tmax = float(args[1]) if len(args) > 1 else 0.8
+    sep = args[2] if len(args) > 2 else None
+    stage = ErpStage(ssn.params.nchannels, ssn.params.sampling_rate, tmin, tmax, (tmin, 0.0) if tmin < 0 else None,
+                     ssn.params.Source.scale, condition=(lambda d: d.split(sep)[0]) if sep else None)
+    ssn.add_callback(stage, name='erp', maxlen=1 << 16, overflow='block')  # epochs need every sample
+    G_erp = stage
+
+
+@defcmd('connectivity', '<start|stop|stats|show> [coh|imcoh|plv] [rate_hz] [segment_s] [segments]# - live band coherence / PLV between all channel pairs')
+def cmd_connectivity(ssn: Session, action: str, method: str = 'coh', rate: str = '4', segment: str = '1', segments: str = '16') -> None:
+    global G_connectivity
+    from connectivity import CoherenceStage
+
+    if action == 'stats':
+        if G_connectivity:
+            print(G_connectivity.stats())
+        return
+    if action == 'show':
+        if G_connectivity is None or G_connectivity.latest is None:
+            raise ArgError('no connectivity yet')
+        c = G_connectivity.latest
+        names = ssn.params.electrode_topology
+        for (lo, hi), m in zip(G_connectivity.bands, c.values):
+            print('{} {}-{} Hz @{}'.format(G_connectivity.method, lo, hi, c.index))
+            print('      ' + ' '.join('{:>6}'.format(n[:6]) for n in names))
+            for name, row in zip(names, m):
+                print('{:>6}'.format(name[:6]) + ' '.join('{:6.2f}'.format(v) for v in row))
+        return
+    if G_connectivity is not None:
+        ssn.remove_callback(G_connectivity)
+        print(G_connectivity.stats())
+        G_connectivity = None
+    if action == 'stop':
+        return
+    if action != 'start':
+        raise ArgError('expected start, stop, stats or show')
+
+    stage = CoherenceStage(ssn.params.nchannels, ssn.params.sampling_rate, float(segment), int(segments), float(rate), method=method)
+    ssn.add_callback(stage, name='connectivity', maxlen=1 << 16, overflow='block')  # segments need every sample
+    G_connectivity = stage
+
+
+@defcmd('record_local', '<file># - open a new file to save data to; closed on exit')
 def cmd_record_local(ssn: Session, fname: str) -> None:
     from utils import open_record
 
-    writer = open_record(name=fname, srate=ssn.params.sampling_rate)
-    ssn.add_callback(writer)
+    writer = open_record(name=fname, srate=ssn.params.sampling_rate, scale=ssn.params.Source.scale)
+    G_recorders.append(writer)
+    ssn.add_callback(writer, name='record ' + fname, maxlen=1 << 16, overflow='block')  # never lose recorded data
+
+
+@defcmd('record_bdf', '<file|stop># - record raw counts and session annotations to records/<file> (BDF+), as they come')
+def cmd_record_bdf(ssn: Session, fname: str) -> None:
+    from bdf import BdfWriter
+
+    if fname == 'stop':
+        for w in [r for r in G_recorders if isinstance(r, BdfWriter)]:
+            ssn.remove_callback(w)
+            w.close()
+            G_recorders.remove(w)
+        return
+    writer = BdfWriter('records/' + fname, ssn.params.electrode_topology, ssn.params.sampling_rate, ssn.params.Source.scale)
+    writer.follow(ssn.annotations)
+    G_recorders.append(writer)
+    ssn.add_callback(writer, name='record ' + fname, maxlen=1 << 16, overflow='block')
+
+
+@defcmd('export_bdf', '[file] [out]# - SD .TXT, csv record or .npy to BDF+ with session annotations; default: SD card file, out: file.bdf')
+def cmd_export_bdf(ssn: Session, fname: Optional[str] = None, out: Optional[str] = None) -> None:
+    import bdf
+
+    fname = fname or ssn.sd_out_file
+    if not fname:
+        raise ArgError('no file and no SD card file in session')
+    out = out or fname + '.bdf'
+    t0 = time.time()
+    n = bdf.export(ssn.params.Source.iter_counts(fname, ssn.params), out, ssn.params.electrode_topology,
+                   ssn.params.sampling_rate, ssn.params.Source.scale, ssn.tstart or os.path.getmtime(fname), ssn.annotations)
+    print('{}: {} samples, {:.1f} MB in {:.2f}s'.format(out, n, os.path.getsize(out) / 1e6, time.time() - t0))
+
+
+@defcmd('publish', '<address|stop># - publish samples to local subscribers; address: unix:<path> or tcp:<host>:<port>')
+def cmd_publish(ssn: Session, address: str) -> None:
+    from netstream import Publisher
+
+    if address == 'stop':
+        for p in G_publishers:
+            ssn.remove_callback(p.callback)
+            p.stop()
+        G_publishers.clear()
+    else:
+        p = Publisher(address)
+        G_publishers.append(p)
+        ssn.add_callback(p.callback, name='publish ' + address, overflow='drop_newest')
 
 
 @defcmd('record_sd', '<mode:ASFGHJKLa># - open a new file on SD card')
@@ -191,11 +456,15 @@ def cmd_record(ssn: Session, mode: str) -> None:
 
 
 @defcmd('sstart', '# - start streaming from the board')
-@in_thread
+@in_acquisition_task
 def cmd_sstart(ssn: Session) -> None:
     if ssn.board and not ssn.board.streaming:
+        tasks.on_cancel(ssn.board.stop)
         ssn.start()
-        ssn.board.start_streaming(ssn.callback)
+        try:
+            ssn.board.start_streaming(ssn.callback)
+        finally:  # sstop, kill or exit: the streaming thread closes the session's stream itself
+            ssn.stop()
     else:
         raise Exception('No board connected')
 
@@ -203,17 +472,26 @@ def cmd_sstart(ssn: Session) -> None:
 @defcmd('sstop', '# - stop stream')
 def cmd_sstop(ssn: Session) -> None:
     if ssn.board and ssn.board.streaming:
-        ssn.board.stop()
-    ssn.stop()
-
+        ssn.board.stop()  # the sstart task calls ssn.stop() once the stream loop returns
+    elif ssn.tstop < ssn.tstart:  # started, but not by a board stream that is still running
+        ssn.stop()
 
-@defcmd('video', '<file># - start video with data collection; board should be preconfigured')
-def cmd_vstart(ssn: Session, inp_file: str) -> None:
-    import subprocess
-    from vlc_ctrl.player import Player
 
+@defcmd('video', '<file> [vlc|clock]# - start video with data collection; board should be preconfigured; clock: in-process playback with a frame log, streams while playing')
+def cmd_vstart(ssn: Session, inp_file: str, player: str = 'vlc') -> None:
     if not inp_file or len(inp_file) <= 0:
         raise ArgError('Video file name expected')
+    if player == 'vlc':
+        vstart_vlc(inp_file)
+    elif player == 'clock':
+        vstart_clock(ssn, inp_file)
+    else:
+        raise ArgError('expected player: vlc|clock')
+
+
+def vstart_vlc(inp_file: str) -> None:
+    import subprocess
+    from vlc_ctrl.player import Player
 
     input('Press Enter to start...')
     with open(os.devnull,"w") as out:
@@ -232,22 +510,47 @@ def cmd_vstart(ssn: Session, inp_file: str) -> None:
         p.quit(None, None, 0)
 
 
+def vstart_clock(ssn: Session, inp_file: str) -> None:
+    from video import Video
+
+    video = Video(inp_file)
+    input('Press Enter to start...')
+    t0 = start_stream_clocked(ssn)
+    print('Running video sequence')
+    video.run_clocked(t0)
+    cmd_sstop(ssn)
+
+    log = video.frame_log()
+    name = os.path.splitext(os.path.basename(inp_file))[0]
+    fname = 'records/{}_{}_frames.npy'.format(name, ssn._strtime(ssn.tstart))
+    video.save_frame_log(fname)
+    if len(log) > 0:
+        ssn.annotations['onset'] = ssn.annotations['onset'] + [ssn.stream_offset(t0 + float(log['t'][0]))]
+        ssn.annotations['duration'] = ssn.annotations['duration'] + [float(log['t'][-1] - log['t'][0])]
+        ssn.annotations['description'] = ssn.annotations['description'] + [name]
+    print('Video: {} frames shown, {} dropped; frame log: {}'.format(len(log), video.dropped, fname))
+
+
 @defcmd('slideshow', '<dir> <delay> <duration> <rest> [bg]# - start presentation of pictures in directory; board should be preconfigured')
 def cmd_pstart(ssn: Session, dirname: str, delay: float, duration: float, rest: float, bg: str = '#000000') -> None:
     from slideshow import Slideshow
 
     dirname, delay, duration, rest, bg = (dirname, float(delay), float(duration), float(rest), bg)
-    def f(dir: str, delay: float, duration: float, rest: float, bg: str, seed: int) -> None:
+    def f(dir: str, delay: float, duration: float, rest: float, bg: str, seed: int, t0: float, events: mp.Queue) -> None:
         oldstd = sys.stderr
-        with open(os.devnull, "w") as out:
-            sys.stderr = out
-            slideshow = Slideshow(dir, delay, duration, rest, bg, seed)
-            slideshow.start()
-        sys.stderr = oldstd
-
-    # generate annotations
+        try:
+            with open(os.devnull, "w") as out:
+                sys.stderr = out
+                slideshow = Slideshow(dir, delay, duration, rest, bg, seed, t0, events)
+                slideshow.start()
+        finally:
+            sys.stderr = oldstd
+            events.put(None)
+
+    # generate annotations; onsets are estimates until the slideshow reports actual ones
     files = [f.split('.')[0] for f in os.listdir(dirname)]
     random.Random(ssn.random_seed).shuffle(files)
+    first = len(ssn.annotations['onset'])
     onset = [delay+i*(duration + rest) for i in range(len(files))]
     durations = [duration] * len(files)
     ssn.annotations['onset'] = ssn.annotations['onset'] + onset
@@ -261,15 +564,90 @@ def cmd_pstart(ssn: Session, dirname: str, delay: float, duration: float, rest:
     ))
     input('Press Enter to start...')
     # start recording
-    cmd_sstart(ssn)
+    t0 = start_stream_clocked(ssn)
 
-    p = Process(target=f, args=(dirname, delay, duration, rest, bg, ssn.random_seed))
+    events = mp.Queue() # type: mp.Queue
+    p = Process(target=f, args=(dirname, delay, duration, rest, bg, ssn.random_seed, t0, events))
     p.start()
+    shown = []
+    for ev in iter(events.get, None):  # as they are shown, so a running erp stage averages them live
+        shown.append(ev)
+        offset = ssn.stream_offset(ev[2])
+        if G_erp is not None and offset is not None:
+            G_erp.event(int(round(offset * ssn.params.sampling_rate)), ev[0].split('.')[0])
     p.join()
 
     # stop recording
     cmd_sstop(ssn)
 
+    # replace the estimates with one annotation per image actually shown, at its measured onset;
+    # files that failed to load or were not reached (<Escape>) get none
+    for k in ('onset', 'duration', 'description'):
+        ssn.annotations[k] = ssn.annotations[k][:first]
+    for name, _target, actual in shown:
+        ssn.annotations['onset'].append(ssn.stream_offset(actual))
+        ssn.annotations['duration'].append(duration)
+        ssn.annotations['description'].append(name.split('.')[0])
+    print('Shown {} of {} images'.format(len(shown), len(files)))
+    print(timeline.format_jitter(timeline.jitter_stats([a - t for _, t, a in shown])))
+
+@defcmd('consumers', '# - show pipeline consumers health')
+def cmd_consumers(ssn: Session) -> None:
+    for name, st in ssn.consumer_stats().items():
+        print('{:30} {}processed {processed} / {offered}, dropped {dropped}, errors {errors}, queue {depth} (max {max_depth}), busy {busy:.2f}s'.format(
+            name, '' if st['alive'] else 'DEAD ', **st))
+        if st['last_error']:
+            print('  last error: {}'.format(st['last_error']))
+
+
+@defcmd('metrics', '<start|stop|show> [port] [file] [period]# - serve metrics for Prometheus on port (default 9108, 0 - off), append JSON lines to file every period seconds')
+def cmd_metrics(ssn: Session, action: str, port: str = '9108', fname: str = None, period: str = '10') -> None:
+    if action == 'start':
+        if G_metrics:
+            raise Exception('Metrics already exported, stop first')
+        metrics.REGISTRY.collector('session', ssn.metrics_collector())
+        if int(port):
+            server = metrics.MetricsServer(int(port))
+            print('Serving metrics on http://{}/metrics'.format(server.address))
+            G_metrics.append(server)
+        if fname:
+            G_metrics.append(metrics.JsonLinesExporter(fname, float(period)))
+    elif action == 'stop':
+        for m in G_metrics:
+            m.stop()
+        G_metrics.clear()
+    elif action == 'show':
+        metrics.REGISTRY.collector('session', ssn.metrics_collector())
+        for k, v in sorted(metrics.REGISTRY.snapshot().items()):
+            if isinstance(v, dict):
+                print('{:60} count {count}, mean {mean:.6f}'.format(k, mean=v['sum'] / max(1, v['count']), **v))
+            else:
+                print('{:60} {:g}'.format(k, v))
+    else:
+        raise ArgError('expected start|stop|show')
+
+
+@defcmd('jobs', '# - list background tasks')
+def cmd_jobs(ssn: Session) -> None:
+    for t in G_tasks.list():
+        print(t)
+
+
+@defcmd('kill', '<id|all># - stop background task')
+def cmd_kill(ssn: Session, id: str) -> None:
+    if id == 'all':
+        G_tasks.cancel_all()
+    else:
+        G_tasks.cancel(int(id))
+
+
+@defcmd('clock', '# - show board vs host clock estimate')
+def cmd_clock(ssn: Session) -> None:
+    print(ssn.clock)
+    for k, v in ssn.clock.stats().items():
+        print('  {}: {}'.format(k, v))
+
+
 @defcmd('c', '<command># - command to send to the board')
 def cmd_c(ssn: Session, *args: str) -> None:
     if not ssn.board:
@@ -279,18 +657,29 @@ def cmd_c(ssn: Session, *args: str) -> None:
     ssn.board.print_incoming_text()
 
 
-@defcmd('rand', '<start|stop># - generate random noise')
-@in_thread
+@defcmd('rand', '# - generate random noise; stop with kill <id>')
+@in_acquisition_task
 def cmd_rand(ssn: Session) -> None:
     ssn.params.Source.gen_rand(ssn.params, ssn.callback)
 
 
+def start_stream_clocked(ssn: Session) -> float:
+    # sstart runs in its own thread; wait for it to stamp the stream start so stimuli can be timed from it
+    requested = timeline.clock()
+    cmd_sstart(ssn)
+    while ssn.tstart_clock < requested and timeline.clock() - requested < 1.0:
+        time.sleep(0.001)
+    if ssn.tstart_clock < requested:
+        raise Exception('Stream did not start within 1s (see jobs); not running stimuli without data')
+    return ssn.tstart_clock
+
+
 def exec_cmd(cmd: str, ssn: Session, args: List) -> None:
     G_cmds[cmd].func(ssn, *args)
 
 
 def repl(ssn: Session) -> None:
-    while utils.should_run:
+    while not tasks.shutting_down():
         full_cmd = input(">>> ").split(' ') # TODO: escape chars
         if not full_cmd or len(full_cmd) <= 0:
             continue
@@ -303,6 +692,4 @@ def repl(ssn: Session) -> None:
         else:
             print('Unknown cmd: {}'.format(cmd))
 
-    for t in G_threads:
-        print('waiting for {}'.format(t))
-        t.join()
+    G_tasks.shutdown()
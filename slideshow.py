@@ -1,13 +1,21 @@
 from os import listdir
+from typing import Any, Optional, List, Tuple
+import queue
 import random
 import time
+from threading import Thread, Event
 
 import tkinter as tk
 from PIL import Image, ImageTk
 
+import timeline
+
 
 class Slideshow(tk.Tk):
-    def __init__(self, directory: str, delay: float, duration: float, rest: float, bg: str = '#000000', seed: int = 0):
+    # t0: timeline.clock() value the offsets are counted from; events: queue receiving (file, target, onset) in clock time,
+    # as each image is shown
+    def __init__(self, directory: str, delay: float, duration: float, rest: float, bg: str = '#000000', seed: int = 0,
+                 t0: Optional[float] = None, events: Any = None, prefetch: int = 4):
         tk.Tk.__init__(self)
         #hackish way, essentially makes root window
         #as small as possible but still "focused"
@@ -20,6 +28,12 @@ class Slideshow(tk.Tk):
         self.rest = rest
         self.bg = bg
         self.seed = seed
+        self.t0 = t0
+        self.events = events
+        self.prefetch = prefetch
+        self.onsets = [] # type: List[Tuple[str, float, float]]
+        self.next = None # type: Optional[Tuple[str, Any]]
+        self.exhausted = False
 
     def start(self):
         self.bind_all("<Escape>", lambda e: self.destroy())
@@ -28,20 +42,102 @@ class Slideshow(tk.Tk):
         self.window.attributes('-topmost', True)
         self.cycle()
 
+    def _show_next(self, target: float) -> None:
+        if self.next is None and not self.exhausted:
+            self._prepare_next(block=True)  # decode fell behind: this onset will be late, and measured so
+        if self.next is None:
+            return
+        (name, photo), self.next = self.next, None
+        if photo is not None:  # a file that failed to decode keeps its slot blank and is not reported
+            self.onsets.append((name, target, self.window.show_photo(photo)))
+            if self.events is not None:  # right away: listeners may use onsets while the slideshow runs
+                self.events.put(self.onsets[-1])
+        self._prepare_next()
+
+    def _prepare_next(self, block: bool = False) -> None:
+        # PhotoImage has to be made on the Tk thread; do it right after an onset, not before the next one.
+        # Never waits for the decoder inside a timed action unless the image is due now
+        if self.next is not None or self.exhausted:
+            return
+        try:
+            item = self.cache.get(block)
+        except queue.Empty:
+            return
+        if item is None:
+            self.exhausted = True
+        else:
+            self.next = (item[0], None if item[1] is None else ImageTk.PhotoImage(item[1]))
+
     def cycle(self):
         self.window.show_blank()
-        time.sleep(self.delay)
         files = listdir(self.directory)
         random.Random(self.seed).shuffle(files)
-        for iname in files:
-            img = Image.open(self.directory+ iname)
-            self.window.show_image(img)
-            time.sleep(self.duration)
-            self.window.show_blank()
-            time.sleep(self.rest)
+        self.cache = ImageCache(self.directory, files, self.window.winfo_screenwidth(), self.window.winfo_screenheight(), self.prefetch)
+        tl = timeline.Timeline(self.t0)
+        for i, iname in enumerate(files):
+            onset = self.delay + i*(self.duration + self.rest)
+            tl.add(onset, iname, lambda o=onset: self._show_next(tl.t0 + o))  # type: ignore
+            tl.add(onset + self.duration, '', self.window.show_blank)
+        tl.add(len(files)*(self.duration + self.rest) + self.delay, '', lambda: None)
+        try:
+            self._prepare_next(block=True)  # before the clock starts, waiting is free
+            tl.run()
+        finally:
+            self.cache.stop()
         self.destroy()
 
 
+# Decodes and scales images in a background thread, staying at most `ahead` images in front of the display
+class ImageCache:
+    def __init__(self, directory: str, files: List[str], width: int, height: int, ahead: int = 4):
+        self.directory = directory
+        self.files = files
+        self.width = width
+        self.height = height
+        self.queue = queue.Queue(max(1, ahead)) # type: queue.Queue
+        self.should_run = Event()
+        self.should_run.set()
+        self.thread = Thread(target=self._run, name='slideshow-prefetch', daemon=True)
+        self.thread.start()
+
+    def _load(self, name: str) -> Image.Image:
+        img = Image.open(self.directory + name)
+        img.draft('RGB', (self.width, self.height))  # cheap DCT downscale for JPEG
+        img = img.convert('RGB')
+        img.thumbnail((self.width, self.height), Image.LANCZOS)
+        return img
+
+    def _put(self, item: Any) -> bool:
+        while self.should_run.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self) -> None:
+        try:
+            for name in self.files:
+                try:
+                    img = self._load(name)
+                except Exception as e:  # not an image, truncated, ...: keep the slot, show nothing
+                    print('slideshow: skipping {}: {}'.format(name, e))
+                    img = None
+                if not self._put((name, img)):
+                    return
+        finally:
+            self._put(None)  # end of sequence
+
+    def get(self, block: bool = True) -> Optional[Tuple[str, Optional[Image.Image]]]:
+        # (name, image or None if it failed to load), None at the end; queue.Empty if not blocking and not ready
+        return self.queue.get(block)
+
+    def stop(self) -> None:
+        self.should_run.clear()
+        self.thread.join()
+
+
 class Window(tk.Toplevel):
     def __init__(self, bg, *args, **kwargs):
         tk.Toplevel.__init__(self, *args, **kwargs)
@@ -52,19 +148,15 @@ class Window(tk.Toplevel):
         self.bg = bg
         self.label = tk.Label(self)
         self.label.pack(side="top", fill="both", expand=True)
+        self.photo = None # type: Any
 
-
-    def show_image(self, image):
-        img_w, img_h = image.size
-        width = min(self.winfo_screenwidth(), img_w)
-        height = min(self.winfo_screenheight(), img_h)
-        image.thumbnail((width, height), Image.ANTIALIAS)
-
-        # create new image
-        persistent_image = ImageTk.PhotoImage(image)
-        self.label.configure(image=persistent_image, bg=self.bg)
+    def show_photo(self, photo: Any) -> float:
+        self.photo = photo  # keep a reference, Tk does not
+        self.label.configure(image=photo, bg=self.bg)
         self.update()
+        return timeline.clock()
 
     def show_blank(self):
         self.label.configure(image='', bg=self.bg)
         self.update()
+        self.photo = None
@@ -0,0 +1,80 @@
+from typing import List, Tuple, Any, Sequence
+from functools import lru_cache
+
+import mne
+import numpy as np
+
+from topology import electrodes, get_topology
+
+
+def parse_pairs(s: str) -> List[Tuple[str, str]]:
+    # 'FZ-CZ,P3-PZ' -> [('FZ', 'CZ'), ('P3', 'PZ')]
+    return [tuple(p.split('-', 1)) for p in s.split(',') if p] # type: ignore
+
+
+def car_matrix(n: int) -> np.ndarray:
+    return np.eye(n) - np.full((n, n), 1.0 / n)
+
+
+def laplacian_matrix(topology: Sequence[str], neighbours: int = 4) -> np.ndarray:
+    # each channel minus the mean of its nearest neighbours on the head map
+    n = len(topology)
+    k = min(neighbours, n - 1)
+    pos = np.array([[electrodes[e].x, electrodes[e].y] for e in topology])
+    dist = np.linalg.norm(pos[:, np.newaxis, :] - pos[np.newaxis, :, :], axis=2)
+    np.fill_diagonal(dist, np.inf)
+    m = np.eye(n)
+    if k > 0:
+        nearest = np.argsort(dist, axis=1)[:, :k]
+        m[np.arange(n)[:, np.newaxis], nearest] = -1.0 / k
+    return m
+
+
+def bipolar_matrix(topology: Sequence[str], pairs: Sequence[Tuple[str, str]]) -> np.ndarray:
+    idx = {name: i for i, name in enumerate(topology)}
+    m = np.zeros((len(pairs), len(topology)))
+    for r, (a, b) in enumerate(pairs):
+        if a not in idx or b not in idx:
+            raise Exception('Pair {}-{} not in topology {}'.format(a, b, list(topology)))
+        m[r, idx[a]] = 1.0
+        m[r, idx[b]] = -1.0
+    return m
+
+
+class SpatialFilter:
+    def __init__(self, matrix: np.ndarray, ch_names: List[str], kind: str) -> None:
+        self.matrix = matrix
+        self.ch_names = ch_names
+        self.kind = kind
+
+    def preserves_channels(self) -> bool:
+        return self.matrix.shape[0] == self.matrix.shape[1]
+
+    def __call__(self, block: Any) -> np.ndarray:
+        # (nchannels,) or (nchannels x n) -> re-referenced; one matrix multiply
+        return self.matrix @ block
+
+
+@lru_cache(maxsize=None)
+def _build(kind: str, topology: Tuple[str, ...], pairs: Tuple[Tuple[str, str], ...]) -> SpatialFilter:
+    if kind == 'car':
+        return SpatialFilter(car_matrix(len(topology)), list(topology), kind)
+    elif kind == 'laplacian':
+        return SpatialFilter(laplacian_matrix(topology), list(topology), kind)
+    elif kind == 'bipolar':
+        return SpatialFilter(bipolar_matrix(topology, pairs), ['{}-{}'.format(a, b) for a, b in pairs], kind)
+    else:
+        raise Exception('Unknown spatial filter {}; expected car|laplacian|bipolar'.format(kind))
+
+
+def make_filter(kind: str, topology_name: str, pairs: Sequence[Tuple[str, str]] = ()) -> SpatialFilter:
+    # matrices are built once per (kind, topology, montage) and reused
+    return _build(kind, tuple(get_topology(topology_name)), tuple(tuple(p) for p in pairs)) # type: ignore
+
+
+def apply_raw(raw: mne.io.RawArray, filt: SpatialFilter) -> mne.io.RawArray:
+    data = filt.matrix @ raw.get_data()
+    info = mne.create_info(ch_names=filt.ch_names, sfreq=raw.info['sfreq'], ch_types='eeg', verbose=None)
+    out = mne.io.RawArray(data, info)
+    out.set_annotations(raw.annotations)
+    return out
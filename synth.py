@@ -0,0 +1,177 @@
+from typing import List, Iterator, Tuple, Optional, IO
+import argparse
+import time
+
+import numpy as np
+from scipy.signal import lfilter
+
+from cyton_source import SCALE_FACTOR_EEG
+from topology import electrodes, get_topology
+import utils
+
+# Paul Kellet's pink (1/f) noise filter
+PINK_B = [0.049922035, -0.095993537, 0.050612699, -0.004408786]
+PINK_A = [1, -2.494956002, 2.017265875, -0.522189400]
+
+
+# Multichannel EEG-like signal generated block by block (all channels at once); every component keeps
+# its state across blocks so the stream is continuous. Yields (microvolts nch x n, valid mask n).
+class SyntheticEEG:
+    def __init__(self, topology: List[str], sampling_rate: int, seed: int = 0,
+                 background: float = 15.0, alpha: float = 20.0, blink: float = 150.0, blink_rate: float = 0.25,
+                 line: float = 5.0, line_freq: float = 50.0, dropout_rate: float = 0.002, dropout_len: float = 0.1) -> None:
+        self.sr = sampling_rate
+        self.nch = len(topology)
+        self.rng = np.random.default_rng(seed)
+        self.background = background
+        self.alpha = alpha
+        self.blink = blink
+        self.blink_rate = blink_rate
+        self.line = line
+        self.line_freq = line_freq
+        self.dropout_rate = dropout_rate
+        self.dropout_len = dropout_len
+        y = np.array([electrodes[e].y for e in topology])
+        self.posterior = np.clip(y / 0.4, 0, 1)[:, np.newaxis]  # alpha is strongest at the back
+        self.frontal = np.clip(-y / 0.4, 0, 1)[:, np.newaxis] ** 2  # blinks at the front
+        self.line_gain = self.rng.uniform(0.5, 1.5, (self.nch, 1))
+        self.pink_zi = np.zeros((self.nch, len(PINK_A) - 1))
+        # alpha envelope: low-passed noise (~0.5 Hz), rectified
+        self.env_b, self.env_a = [1 - np.exp(-2 * np.pi * 0.5 / self.sr)], [1, -np.exp(-2 * np.pi * 0.5 / self.sr)]
+        self.env_zi = np.zeros(1)
+        blink_n = int(0.3 * self.sr)
+        self.blink_shape = np.sin(np.pi * np.arange(blink_n) / blink_n)
+        self.carry = np.zeros((self.nch, blink_n))  # blink tails running into the next block
+        self.dropout_left = 0
+        self.n = 0  # samples generated so far
+
+    def block(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        t = (self.n + np.arange(n)) / self.sr
+        noise = self.rng.standard_normal((self.nch, n))
+        pink, self.pink_zi = lfilter(PINK_B, PINK_A, noise, axis=1, zi=self.pink_zi)
+        out = pink * (self.background / 0.1)  # filter output std is ~0.1 for unit white noise
+
+        env, self.env_zi = lfilter(self.env_b, self.env_a, self.rng.standard_normal(n), zi=self.env_zi)
+        env = np.maximum(env / 0.03 - 0.5, 0)  # bursts only when the envelope is high
+        out += self.alpha * self.posterior * (env * np.sin(2 * np.pi * 10.0 * t))
+
+        out += self.line * self.line_gain * np.sin(2 * np.pi * self.line_freq * t)
+
+        bl = len(self.blink_shape)
+        blinks = np.zeros(n + bl)
+        onsets = np.flatnonzero(self.rng.random(n) < self.blink_rate / self.sr)
+        for o in onsets:
+            blinks[o:o + bl] += self.blink_shape
+        k = min(n, bl)
+        out[:, :k] += self.carry[:, :k]
+        self.carry = np.concatenate([self.carry[:, k:], np.zeros((self.nch, k))], axis=1)
+        out += self.blink * self.frontal * blinks[:n]
+        self.carry += self.blink * self.frontal * blinks[n:n + bl]
+
+        valid = np.ones(n, dtype=bool)
+        i = 0
+        while i < n:  # dropouts: runs of lost samples
+            if self.dropout_left > 0:
+                m = min(self.dropout_left, n - i)
+                valid[i:i + m] = False
+                self.dropout_left -= m
+                i += m
+                continue
+            starts = np.flatnonzero(self.rng.random(n - i) < self.dropout_rate / self.sr)
+            if len(starts) == 0:
+                break
+            i += starts[0]
+            self.dropout_left = max(1, int(self.rng.exponential(self.dropout_len) * self.sr))
+        self.n += n
+        return out, valid
+
+    def blocks(self, nsamples: int, block: int = 0) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        block = block or 10 * self.sr
+        done = 0
+        while done < nsamples:
+            n = min(block, nsamples - done)
+            yield self.block(n)
+            done += n
+
+
+def to_counts(uv: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(uv / SCALE_FACTOR_EEG), -2**23, 2**23 - 1).astype(np.int32)
+
+
+HEX = np.frombuffer(b'0123456789ABCDEF', dtype=np.uint8)
+
+
+def txt_lines(counts: np.ndarray, first: int) -> bytes:
+    # SD card format: 2 hex digit sample counter, 6 hex digit 24-bit two's complement per channel, 3 aux fields
+    nch, n = counts.shape
+    width = 3 + 7 * nch + 15  # 'CC,' + channels 'XXXXXX,'/'XXXXXX' + ',0000,0000,0000\n'
+    buf = np.empty((n, width), dtype=np.uint8)
+    counter = (first + np.arange(n)) % 256
+    buf[:, 0] = HEX[counter >> 4]
+    buf[:, 1] = HEX[counter & 0xF]
+    buf[:, 2] = ord(',')
+    v = (counts.T.astype(np.int64) & 0xFFFFFF)[:, :, np.newaxis] >> np.array([20, 16, 12, 8, 4, 0])
+    digits = HEX[v & 0xF]  # n x nch x 6
+    cols = buf[:, 3:3 + 7 * nch].reshape(n, nch, 7)
+    cols[:, :, :6] = digits
+    cols[:, :, 6] = ord(',')
+    buf[:, 3 + 7 * nch - 1:] = np.frombuffer(b',0000,0000,0000\n', dtype=np.uint8)
+    return buf.tobytes()
+
+
+def write_txt(out: IO, gen: SyntheticEEG, nsamples: int) -> None:
+    counter = 0
+    for uv, valid in gen.blocks(nsamples):
+        lines = np.frombuffer(txt_lines(to_counts(uv), counter), dtype=np.uint8).reshape(uv.shape[1], -1)
+        out.write(lines[valid].tobytes())  # lost samples leave gaps in the counter
+        counter += uv.shape[1]
+
+
+def write_csv(out: IO, gen: SyntheticEEG, nsamples: int) -> None:
+    for uv, valid in gen.blocks(nsamples):
+        np.savetxt(out, uv[:, valid].T, fmt='%.3f', delimiter=',')
+
+
+def write_npy(fname: str, gen: SyntheticEEG, nsamples: int) -> None:
+    # float32 microvolts, nch x nsamples; lost samples are zeros
+    arr = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float32, shape=(gen.nch, nsamples))
+    i = 0
+    for uv, valid in gen.blocks(nsamples):
+        n = uv.shape[1]
+        arr[:, i:i + n] = uv * valid
+        i += n
+    arr.flush()
+
+
+def write(fname: str, fmt: str, gen: SyntheticEEG, nsamples: int) -> None:
+    if fmt == 'txt':
+        with open(fname, 'wb') as out:
+            write_txt(out, gen, nsamples)
+    elif fmt == 'csv':
+        with open(fname, 'w') as out:
+            write_csv(out, gen, nsamples)
+    elif fmt == 'npy':
+        write_npy(fname, gen, nsamples)
+    else:
+        raise Exception('Unsupported format {}; txt, csv or npy expected'.format(fmt))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic EEG recordings')
+    parser.add_argument('out', help='output file; format from extension unless --format')
+    parser.add_argument('--duration', type=float, default=3600, help='seconds')
+    parser.add_argument('--topology', default='top_8c_10_20')
+    parser.add_argument('--sampling_rate', type=int, default=250)
+    parser.add_argument('--format', choices=['txt', 'csv', 'npy'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--line_freq', type=float, default=50.0)
+    args = parser.parse_args()
+
+    fmt = args.format or args.out.rsplit('.', 1)[-1].lower()
+    gen = SyntheticEEG(get_topology(args.topology), args.sampling_rate, seed=args.seed, line_freq=args.line_freq)
+    nsamples = int(args.duration * args.sampling_rate)
+    t0 = time.time()
+    write(args.out, fmt, gen, nsamples)
+    dt = time.time() - t0
+    print('{}: {} of {} channels at {}Hz in {:.1f}s ({:.0f}x real time)'.format(
+        args.out, utils.compact_duration(int(args.duration)), gen.nch, args.sampling_rate, dt, args.duration / max(dt, 1e-9)))
@@ -0,0 +1,163 @@
+from typing import List, Callable, Any, Dict, Optional
+import itertools
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import utils
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+_local = threading.local()
+_shutdown = threading.Event()  # set once when the shell exits; every task's stop condition
+
+
+class Task:
+    def __init__(self, id: int, name: str) -> None:
+        self.id = id
+        self.name = name
+        self.status = PENDING
+        self.submitted = time.time()
+        self.started = 0.0
+        self.finished = 0.0
+        self.error = None # type: Optional[str]
+        self.stop = threading.Event()
+        self.on_cancel = [] # type: List[Callable[[], Any]]
+        self.future = None # type: Optional[Future]
+        self.thread = None # type: Optional[threading.Thread]
+
+    def should_run(self) -> bool:
+        return not self.stop.is_set()
+
+    def cancel(self) -> None:
+        # cooperative: the task checks should_run(); blocking work registers on_cancel hooks to be woken up
+        self.stop.set()
+        if self.future is not None and self.future.cancel():
+            self.status = CANCELLED
+            self.finished = time.time()
+        for f in self.on_cancel:
+            try:
+                f()
+            except Exception as e:
+                print('Error cancelling task {}: {}'.format(self.id, e))
+
+    def elapsed(self) -> float:
+        if not self.started:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self) -> str:
+        return '[{}] {:12} {:10} {}'.format(
+            self.id, self.name, self.status, utils.compact_duration(int(self.elapsed())))
+
+
+def current() -> Optional[Task]:
+    return getattr(_local, 'task', None)
+
+
+def should_run() -> bool:
+    # for background work: false on shell exit or when the running task was killed
+    task = current()
+    return not _shutdown.is_set() and (task is None or task.should_run())
+
+
+def request_shutdown() -> None:
+    _shutdown.set()
+
+
+def shutting_down() -> bool:
+    return _shutdown.is_set()
+
+
+def on_cancel(f: Callable[[], Any]) -> None:
+    task = current()
+    if task is not None:
+        task.on_cancel.append(f)
+
+
+class TaskManager:
+    def __init__(self, workers: int = 8, history: int = 50) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='task')
+        self.tasks = OrderedDict() # type: OrderedDict[int, Task]
+        self.history = history
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def _run(self, task: Task, f: Callable, args: tuple) -> None:
+        if task.stop.is_set():
+            return
+        _local.task = task
+        task.status = RUNNING
+        task.started = time.time()
+        try:
+            f(*args)
+            task.status = CANCELLED if task.stop.is_set() else DONE
+        except Exception:
+            task.status = FAILED
+            task.error = traceback.format_exc()
+            print('Task {} ({}) failed:\n{}'.format(task.id, task.name, task.error))
+        finally:
+            task.finished = time.time()
+            _local.task = None
+
+    def submit(self, name: str, f: Callable, *args: Any, dedicated: bool = False) -> Task:
+        # dedicated: a thread of its own, for work that must start now and may run for the whole session
+        # (acquisition) instead of waiting for a free pool worker
+        with self.lock:
+            task = Task(next(self.ids), name)
+            self.tasks[task.id] = task
+            self._trim()
+        if dedicated:
+            task.thread = threading.Thread(target=self._run, args=(task, f, args), name='task-' + name, daemon=True)
+            task.thread.start()
+        else:
+            task.future = self.pool.submit(self._run, task, f, args)
+        return task
+
+    def _trim(self) -> None:
+        finished = [i for i, t in self.tasks.items() if t.status in (DONE, FAILED, CANCELLED)]
+        for i in finished[:max(0, len(finished) - self.history)]:
+            del self.tasks[i]
+
+    def get(self, id: int) -> Task:
+        if id not in self.tasks:
+            raise Exception('No task {}'.format(id))
+        return self.tasks[id]
+
+    def list(self) -> List[Task]:
+        with self.lock:
+            return list(self.tasks.values())
+
+    def active(self) -> List[Task]:
+        return [t for t in self.list() if t.status in (PENDING, RUNNING)]
+
+    def cancel(self, id: int) -> None:
+        self.get(id).cancel()
+
+    def cancel_all(self) -> None:
+        for t in self.active():
+            t.cancel()
+
+    def join(self, timeout: float) -> bool:
+        # wait for the active tasks to finish; False if some are still running after timeout
+        deadline = time.time() + timeout
+        for t in self.active():
+            if t.thread is not None:
+                t.thread.join(max(0.0, deadline - time.time()))
+            elif t.future is not None:
+                try:
+                    t.future.result(max(0.0, deadline - time.time()))
+                except Exception:
+                    pass
+        return not self.active()
+
+    def shutdown(self) -> None:
+        for t in self.active():
+            print('waiting for {}'.format(t))
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,97 @@
+from typing import List, Optional, Sequence, Tuple, Union
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+CACHE_DIR = 'sessions/cache'
+MEMORY_BUDGET = 256 << 20  # bytes of temporaries for all spectrogram workers together
+
+
+class Spectrogram:
+    # power: (nchannels x nframes x nfreqs) float32, frame i centred at times[i]
+    def __init__(self, power: np.ndarray, sampling_rate: float, nperseg: int, hop: int, ch_names: List[str]) -> None:
+        self.power = power
+        self.sampling_rate = sampling_rate
+        self.nperseg = nperseg
+        self.hop = hop
+        self.ch_names = ch_names
+        self.freqs = np.fft.rfftfreq(nperseg, 1.0 / sampling_rate)
+        self.times = (np.arange(power.shape[1]) * hop + nperseg / 2.0) / sampling_rate
+
+    def slice(self, tmin: float = 0.0, tmax: Optional[float] = None,
+              channels: Optional[Sequence[Union[int, str]]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # -> (power[channels, frames in [tmin, tmax), :], times, freqs); a view for contiguous channels
+        f0 = int(np.searchsorted(self.times, tmin))
+        f1 = len(self.times) if tmax is None else int(np.searchsorted(self.times, tmax))
+        if channels is None:
+            power = self.power[:, f0:f1]
+        else:
+            idx = [self.ch_names.index(c) if isinstance(c, str) else c for c in channels]
+            power = self.power[idx, f0:f1]
+        return power, self.times[f0:f1], self.freqs
+
+
+def fingerprint(data: np.ndarray) -> str:
+    # cheap content id: a strided sample of the data, so re-referenced or re-imported data gets a new cache entry
+    return hashlib.sha1(np.ascontiguousarray(data[:, ::max(1, data.shape[1] // 4096)]).tobytes()).hexdigest()
+
+
+def cache_key(ident: dict) -> str:
+    return hashlib.sha1(json.dumps(ident, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def compute(data: np.ndarray, sampling_rate: float, nperseg: int, hop: int, out: np.ndarray,
+            budget: int = MEMORY_BUDGET, workers: Optional[int] = None) -> None:
+    # Hann-windowed |rfft|^2 density of strided windows, chunk by chunk in a thread pool (fft and
+    # ufuncs release the GIL). At most `workers` chunks are in flight and each is sized so that all
+    # of them together stay within `budget` bytes of temporaries
+    windows = sliding_window_view(data, nperseg, axis=1)[:, ::hop]  # view: nch x nframes x nperseg
+    win = np.hanning(nperseg).astype(np.float32)
+    scale = 1.0 / (sampling_rate * float((win**2).sum()))
+    nch, nframes = windows.shape[:2]
+    workers = workers or os.cpu_count() or 1
+    per_frame = nch * nperseg * 32  # peak bytes per value: detrended copy 8, half spectrum ~8, power ~12
+    chunk_frames = max(1, budget // (workers * per_frame))
+
+    def work(f0: int) -> None:
+        f1 = min(nframes, f0 + chunk_frames)
+        seg = windows[:, f0:f1]
+        seg = seg - seg.mean(axis=2, keepdims=True)  # constant detrend
+        seg *= win
+        spec = np.fft.rfft(seg, axis=2)
+        p = spec.real**2 + spec.imag**2
+        p *= scale
+        p[:, :, 1:(-1 if nperseg % 2 == 0 else None)] *= 2  # one-sided, Nyquist bin only for even lengths
+        out[:, f0:f1] = p
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:  # only running chunks hold temporaries
+        list(pool.map(work, range(0, nframes, chunk_frames)))
+
+
+def spectrogram(data: np.ndarray, sampling_rate: float, ch_names: List[str], ident: dict,
+                window: float = 2.0, overlap: float = 0.5, cache_dir: str = CACHE_DIR) -> Spectrogram:
+    # cached on disk per data identity and parameters; a cache hit is a memory map, no recomputation
+    nperseg = int(round(window * sampling_rate))
+    hop = max(1, int(round(nperseg * (1.0 - overlap))))
+    nch, n = data.shape
+    if n < nperseg:
+        raise Exception('Data shorter than one window ({} < {} samples)'.format(n, nperseg))
+    key = cache_key(dict(ident, nperseg=nperseg, hop=hop, sampling_rate=sampling_rate, shape=[nch, n]))
+    fname = os.path.join(cache_dir, 'tfr_{}.npy'.format(key))
+    if os.path.exists(fname):
+        power = np.load(fname, mmap_mode='r')
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        nframes = (n - nperseg) // hop + 1
+        tmp = fname + '.part.npy'
+        power = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(nch, nframes, nperseg // 2 + 1))
+        compute(data, sampling_rate, nperseg, hop, power)
+        power.flush()
+        del power
+        os.replace(tmp, fname)
+        power = np.load(fname, mmap_mode='r')
+    return Spectrogram(power, sampling_rate, nperseg, hop, ch_names)
@@ -0,0 +1,78 @@
+from typing import List, Callable, Optional, Dict, Any
+
+import math
+import time
+
+# Sleep coarsely until this close to the target, then spin; OS sleep granularity is ~1ms at best
+SPIN_MARGIN = 0.002
+
+
+def clock() -> float:
+    # single monotonic, system-wide clock shared by scheduler, stimuli and acquisition
+    return time.monotonic()
+
+
+def wait_until(target: float) -> float:
+    while True:
+        left = target - clock()
+        if left <= 0:
+            break
+        if left > SPIN_MARGIN:
+            time.sleep(left - SPIN_MARGIN)
+    return clock()
+
+
+def jitter_stats(lateness: List[float]) -> Dict[str, float]:
+    n = len(lateness)
+    if n == 0:
+        return {'n': 0, 'mean': 0.0, 'std': 0.0, 'min': 0.0, 'max': 0.0}
+    mean = sum(lateness) / n
+    std = math.sqrt(sum((l - mean)**2 for l in lateness) / n)
+    return {'n': n, 'mean': mean, 'std': std, 'min': min(lateness), 'max': max(lateness)}
+
+
+def format_jitter(stats: Dict[str, float]) -> str:
+    return 'Jitter over {} events: mean {:.3f}ms, std {:.3f}ms, min {:.3f}ms, max {:.3f}ms'.format(
+        stats['n'], stats['mean']*1000, stats['std']*1000, stats['min']*1000, stats['max']*1000)
+
+
+class Event:
+    def __init__(self, offset: float, name: str, action: Callable[[], Any]) -> None:
+        self.offset = offset
+        self.name = name
+        self.action = action
+        self.dispatched = -1.0  # actual offset from t0; negative until dispatched
+
+    @property
+    def lateness(self) -> float:
+        return self.dispatched - self.offset
+
+
+# Events fire at absolute offsets from t0, so time spent in previous actions does not accumulate
+class Timeline:
+    def __init__(self, t0: Optional[float] = None) -> None:
+        self.t0 = t0
+        self.events = [] # type: List[Event]
+
+    def add(self, offset: float, name: str, action: Callable[[], Any]) -> Event:
+        ev = Event(offset, name, action)
+        self.events.append(ev)
+        return ev
+
+    def run(self, should_run: Callable[[], bool] = lambda: True) -> None:
+        if self.t0 is None:
+            self.t0 = clock()
+        for ev in sorted(self.events, key=lambda e: e.offset):  # stable: same offsets keep insertion order
+            if not should_run():
+                break
+            ev.dispatched = wait_until(self.t0 + ev.offset) - self.t0
+            ev.action()
+
+    def dispatched(self) -> List[Event]:
+        return [e for e in self.events if e.dispatched >= 0]
+
+    def jitter(self) -> Dict[str, float]:
+        return jitter_stats([e.lateness for e in self.dispatched()])
+
+    def report(self) -> str:
+        return format_jitter(self.jitter())
@@ -17,7 +17,7 @@ class Panel:
         raise Exception('Not implemented!')
 
 class VoltageChannel:
-    def __init__(self, c, offset, step, H, W, name=None):
+    def __init__(self, c, offset, step, H, W, name=None, stats=None, index=0):
         self.H = H
         self.W = W
         self.offset = offset
@@ -29,6 +29,8 @@ class VoltageChannel:
         self.amp = 0.0
         self.avg = 0.0
         self.name = name
+        self.stats = stats # type: utils.RollingStats
+        self.index = index
 
         self.avg_amp_period = utils.period_function(0.3, lambda: True)
         self.redraw_period = utils.period_function(1.0/100, lambda: True)
@@ -46,17 +48,9 @@ class VoltageChannel:
         self.header = self.sub_canvas.create_text(5, 5, anchor='nw', text='{}: {} +-{}'.format(self.name,  int(avg), int(amplitude)))
 
     def _get_amp_avg(self):
-        amp = 0.0
-        avg = 0.0
-        l = len(self.items)
-        for _, a in self.items:
-            avg += a
-        avg = avg / l if l > 0 else 0
-
-        for _, a in self.items:
-            k = abs(avg - a)
-            if amp < k:
-                amp = k
+        i = self.index
+        avg = self.stats.mean()[i]
+        amp = max(self.stats.max()[i] - avg, avg - self.stats.min()[i])
         self.amp_hist.append(amp * 1.3 if amp > 100 else 100) # a bit of margin
         self.amp = sum(self.amp_hist)/len(self.amp_hist)
         self.avg = avg
@@ -83,7 +77,7 @@ class VoltageChannel:
         self.last_pt = pt
 
 class Voltages(Panel):
-    def __init__(self, c, topology, x1, y1, x2, y2):
+    def __init__(self, c, topology, x1, y1, x2, y2, stats):
         self.c = c
         self.channels = [] # type: List[VoltageChannel]
         self.nchannels = len(topology)
@@ -96,7 +90,9 @@ class Voltages(Panel):
                 step=5,
                 H=cheight,
                 W=x2-x1-20, # 10 for gaps on both sides
-                name=topology[i]
+                name=topology[i],
+                stats=stats,
+                index=i,
             )
             self.channels.append(channel)
 
@@ -107,9 +103,9 @@ class Voltages(Panel):
             self.channels[i].update(vec[i])
 
 class HeadMap(Panel):
-    def __init__(self, c, topology, x1, y1, x2, y2):
+    def __init__(self, c, topology, x1, y1, x2, y2, stats):
         self.points = [] # type: List[int]
-        self.max = 0.
+        self.stats = stats # type: utils.RollingStats
         self.c = c
         dim = min(abs(x2-x1), abs(y2-y1))
         # nose
@@ -140,19 +136,97 @@ class HeadMap(Panel):
             c.create_text(x0+dim*dx, y0+dim*dy, text=name)
 
     def update(self, vec: Sequence[float]) -> None:
+        peaks = np.maximum(np.abs(self.stats.min()), np.abs(self.stats.max()))
         for i in range(len(self.points)):
             v = vec[i]
             a = abs(v)
-            if a > self.max:
-                self.max = a
-                # print('MAX: {:2f}'.format(a))
-            chanv = 255 - int((1 if self.max == 0 else a/self.max) * 255) % 256
+            peak = peaks[i]
+            chanv = 255 - int((1 if peak == 0 else min(1.0, a/peak)) * 255) % 256
             if v < 0:
                 clr = '#{0:02x}{0:02x}ff'.format(chanv)
             else:
                 clr = '#ff{0:02x}{0:02x}'.format(chanv)
             self.c.itemconfig(self.points[i], fill=clr)
 
+def diverging_lut() -> np.ndarray:
+    # 256 x RGB: blue (negative) - white - red (positive)
+    t = np.linspace(-1.0, 1.0, 256)
+    lut = np.empty((256, 3), dtype=np.uint8)
+    lut[:, 0] = np.where(t < 0, 255 * (1 + t), 255)
+    lut[:, 1] = 255 * (1 - np.abs(t))
+    lut[:, 2] = np.where(t > 0, 255 * (1 - t), 255)
+    return lut
+
+
+class ScalpMap(Panel):
+    # Inverse-distance interpolation weights from electrodes to the pixel grid are computed once;
+    # a frame is one weights @ values product and a colour lookup into a reused PPM buffer,
+    # rendered at low resolution and zoomed by Tk.
+    def __init__(self, c, topology, x1, y1, x2, y2, stats, res=160, fps=25, power=2.0):
+        self.c = c
+        self.stats = stats # type: utils.RollingStats
+        self.nchannels = len(topology)
+        self.period = utils.period_function(1.0/fps, lambda: True)
+        dim = min(abs(x2-x1), abs(y2-y1))
+        x0 = x1+dim/2
+        y0 = y1+dim/2
+        r = dim*0.4
+        self.scale = max(1, int(2*r/res))
+        self.res = int(2*r/self.scale)
+
+        # pixel centres in electrode (dim-relative) coordinates
+        px = ((np.arange(self.res) + 0.5) * self.scale - r) / dim
+        gx, gy = np.meshgrid(px, px)
+        inside = (gx**2 + gy**2) <= (r/dim)**2
+        self.inside = np.flatnonzero(inside)
+        pos = np.array([[electrodes[e].x, electrodes[e].y] for e in topology])
+        d2 = (gx.ravel()[self.inside, np.newaxis] - pos[:, 0])**2 + (gy.ravel()[self.inside, np.newaxis] - pos[:, 1])**2
+        w = 1.0 / (d2 + 1e-6)**(power/2)
+        self.weights = (w / w.sum(axis=1)[:, np.newaxis]).astype(np.float32)
+        self.lut = diverging_lut()
+        self.idx = np.empty(len(self.inside), dtype=np.intp)
+        self.colors = np.empty((len(self.inside), 3), dtype=np.uint8)
+
+        header = 'P6 {} {} 255 '.format(self.res, self.res).encode()
+        self.ppm = bytearray(header + bytes(self.res*self.res*3))
+        self.rgb = np.frombuffer(self.ppm, dtype=np.uint8, offset=len(header)).reshape(-1, 3)
+        self.rgb[:] = 153  # canvas background
+        self.small = tk.PhotoImage(width=self.res, height=self.res)
+        self.big = tk.PhotoImage(width=self.res*self.scale, height=self.res*self.scale)
+        side = self.res*self.scale
+        c.create_image(x0-side/2, y0-side/2, image=self.big, anchor=tk.NW)
+
+        # nose
+        c.create_polygon(
+            [
+                x1+dim/2-dim/8, y1+dim/10*2,
+                x1+dim/2, y1+dim/30,
+                x1+dim/2+dim/8, y1+dim/10*2],
+            outline='black',
+            fill='white',
+        )
+        c.create_oval(x0-r, y0-r, x0+r, y0+r, outline='black', width=2)
+        diameter = int(dim/120)+1
+        for name in topology:
+            e = electrodes[name]
+            ex, ey = x0+dim*e.x, y0+dim*e.y
+            c.create_oval(ex-diameter, ey-diameter, ex+diameter, ey+diameter, fill='black')
+            c.create_text(ex, ey-3*diameter, text=name)
+
+    def update(self, vec: Sequence[float]) -> None:
+        if not self.period():
+            return
+        values = np.asarray(vec[:self.nchannels], dtype=np.float32)
+        peak = max(float(np.max(np.maximum(np.abs(self.stats.min()), np.abs(self.stats.max())))), 1e-9)
+        z = self.weights @ values
+        np.clip(z * (127.5/peak) + 127.5, 0, 255, out=z)
+        self.idx[:] = z
+        np.take(self.lut, self.idx, axis=0, out=self.colors)
+        self.rgb[self.inside] = self.colors
+        self.small.configure(data=bytes(self.ppm), format='PPM')
+        self.big.tk.call(self.big, 'copy', self.small, '-zoom', self.scale, self.scale)
+
+
 class FftChannel:
     def __init__(self, c, offset, step, H, W, name, nsamples):
         self.H = H
@@ -240,12 +314,15 @@ class TkInterGui:
     W=1400
     started = False
 
-    def __init__(self, topology: List[str], sampling_rate: int):
+    def __init__(self, topology: List[str], sampling_rate: int, scale: float = 1.0):
         self.last_update = 0.
         self.sampling_rate = sampling_rate
+        self.scale = scale
         self.topology = topology
         self.nchannels = len(topology)
         self.panels = [] # type: List[Panel]
+        # shared by all panels; window of a couple of seconds for autoscale and colour range
+        self.stats = utils.RollingStats(self.nchannels, window=2*sampling_rate)
         self.root = tk.Tk()
         self.c = tk.Canvas(self.root, height=self.H, width=self.W, bg='#999999')
 
@@ -259,16 +336,18 @@ class TkInterGui:
             x1=0,
             y1=0,
             x2=self.W-self.H,
-            y2=self.H
+            y2=self.H,
+            stats=self.stats,
         ))
         # Init Map
-        self.panels.append(HeadMap(
+        self.panels.append(ScalpMap(
             self.c,
             self.topology,
             x1=self.W-self.H,
             y1=0,
             x2=self.W,
-            y2=self.H
+            y2=self.H,
+            stats=self.stats,
         ))
         # Init FFT
         # self.panels.append(FFT(
@@ -298,14 +377,20 @@ class TkInterGui:
         self.update()
         self.root.destroy()
 
-    def consume(self, vec: Sequence[float]) -> None:
-        for p in self.panels:
-            p.update(vec)
+    def consume(self, block: Any) -> None:
+        uv = np.asarray(block, dtype=np.float64) * self.scale  # raw counts -> microvolts, only here
+        if uv.ndim == 1:
+            uv = uv[:, np.newaxis]
+        self.stats.update(uv)
+        for vec in uv.T:
+            for p in self.panels:
+                p.update(vec)
         self.root.update()
 
     @classmethod
     def get_params(self, params: Parameters) -> Dict[str, Any]:
         return {
             'topology': params.electrode_topology,
-            'sampling_rate': params.sampling_rate
+            'sampling_rate': params.sampling_rate,
+            'scale': params.Source.scale
         }
@@ -1,19 +1,15 @@
-from typing import MutableSequence, List, Callable, TypeVar, IO, Type, Optional, Any
+from typing import MutableSequence, List, Callable, TypeVar, IO, Type, Optional, Any, Iterator
 T = TypeVar('T')
 
 import time
-from threading import Thread
 from datetime import datetime
 from collections import deque
 
 import numpy as np
 
+import metrics
+import timeline
 
-should_run = True
-
-def should_stop() -> None:
-    global should_run
-    should_run = False
 
 def period_function(period: float, target: Callable) -> Callable:
     last = time.time()
@@ -70,39 +66,186 @@ class FFTCollector():
         return list(map(self.fft_channel, self.channel_buffers))
 
 
+# Windowed per-channel mean/variance/min/max/rms over the last ~`window` samples.
+# The window is a ring of `nchunks` chunk summaries, so an update is a few vector ops regardless of
+# the window length; the window slides by one chunk at a time.
+class RollingStats:
+    def __init__(self, nchannels: int, window: int, nchunks: int = 10):
+        self.nchannels = nchannels
+        self.nchunks = nchunks
+        self.chunk_len = max(1, window // nchunks)
+        self.window = self.chunk_len * nchunks
+        self.sums = np.zeros((nchunks, nchannels))
+        self.sqs = np.zeros((nchunks, nchannels))
+        self.mins = np.full((nchunks, nchannels), np.inf)
+        self.maxs = np.full((nchunks, nchannels), -np.inf)
+        self.filled = 0
+        self.pos = 0
+        self.total_sum = np.zeros(nchannels)
+        self.total_sq = np.zeros(nchannels)
+        self.shift = None # type: Optional[np.ndarray]  # first sample, keeps sums of squares well conditioned
+        self._new_chunk()
+
+    def _new_chunk(self) -> None:
+        self.cur_n = 0
+        self.cur_sum = np.zeros(self.nchannels)
+        self.cur_sq = np.zeros(self.nchannels)
+        self.cur_min = np.full(self.nchannels, np.inf)
+        self.cur_max = np.full(self.nchannels, -np.inf)
+
+    def _close_chunk(self) -> None:
+        p = self.pos
+        self.total_sum += self.cur_sum - self.sums[p]
+        self.total_sq += self.cur_sq - self.sqs[p]
+        self.sums[p], self.sqs[p], self.mins[p], self.maxs[p] = self.cur_sum, self.cur_sq, self.cur_min, self.cur_max
+        self.pos = (p + 1) % self.nchunks
+        self.filled = min(self.filled + 1, self.nchunks)
+        if self.pos == 0:  # drop accumulated rounding error once per window
+            self.total_sum = self.sums.sum(axis=0)
+            self.total_sq = self.sqs.sum(axis=0)
+        self._new_chunk()
+
+    def update(self, block: Any) -> None:
+        # block: one sample (nchannels,) or (nchannels x n) samples
+        arr = np.asarray(block, dtype=np.float64)
+        if self.shift is None:
+            self.shift = (arr if arr.ndim == 1 else arr[:, 0]).copy()
+        if arr.ndim == 1:  # per-sample fast path
+            v = arr - self.shift
+            self.cur_sum += v
+            self.cur_sq += v * v
+            np.minimum(self.cur_min, v, out=self.cur_min)
+            np.maximum(self.cur_max, v, out=self.cur_max)
+            self.cur_n += 1
+            if self.cur_n == self.chunk_len:
+                self._close_chunk()
+            return
+        arr = arr - self.shift[:, np.newaxis]
+        i = 0
+        n = arr.shape[1]
+        while i < n:
+            j = min(n, i + self.chunk_len - self.cur_n)
+            part = arr[:, i:j]
+            self.cur_sum += part.sum(axis=1)
+            self.cur_sq += np.einsum('ij,ij->i', part, part)
+            np.minimum(self.cur_min, part.min(axis=1), out=self.cur_min)
+            np.maximum(self.cur_max, part.max(axis=1), out=self.cur_max)
+            self.cur_n += j - i
+            if self.cur_n == self.chunk_len:
+                self._close_chunk()
+            i = j
+
+    @property
+    def count(self) -> int:
+        return self.filled * self.chunk_len + self.cur_n
+
+    def _shift(self) -> np.ndarray:
+        return np.zeros(self.nchannels) if self.shift is None else self.shift
+
+    def _mean_shifted(self) -> np.ndarray:
+        return (self.total_sum + self.cur_sum) / max(1, self.count)
+
+    def mean(self) -> np.ndarray:
+        return self._mean_shifted() + self._shift()
+
+    def var(self) -> np.ndarray:
+        m = self._mean_shifted()
+        return np.maximum(0.0, (self.total_sq + self.cur_sq) / max(1, self.count) - m * m)
+
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.var())
+
+    def rms(self) -> np.ndarray:
+        m = self.mean()
+        return np.sqrt(self.var() + m * m)
+
+    def min(self) -> np.ndarray:
+        if self.count == 0:
+            return np.zeros(self.nchannels)
+        return np.minimum(self.mins.min(axis=0), self.cur_min) + self._shift()
+
+    def max(self) -> np.ndarray:
+        if self.count == 0:
+            return np.zeros(self.nchannels)
+        return np.maximum(self.maxs.max(axis=0), self.cur_max) + self._shift()
+
+
 def vec_to_csv(out: IO, vec: np.ndarray) -> None:
     a = np.array2string(vec, max_line_width=999999, separator=',')[1:-1] # skip [ & ]
     out.write('{}\n'.format(a))
 
 
-def open_record(name: str = None, srate: int = 0, ext: str = 'csv', mode: str = 'w') -> Callable[[T], T]:
-    if not name:
-        name = f'{datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}_{srate}.{ext}'
-    name = 'records/' + name
-    out = open(name, mode)
-    data = deque() # type: deque
-
-    def record_monitor() -> None:
-        while should_run:
-            time.sleep(1)
-        if len(data) > 0:
-            print('INFO: Flushing {}'.format(name))
-        for r in data:
-            if isinstance(r, np.ndarray):
-                out.write(','.join([str(i) for i in r])+'\n')
-            else:
-                print('{} is not a np.array'.format(r))
-        out.close()
-        data.clear()
-
-    Thread(target=record_monitor, name=name+'record_monitor').start()
-
-    def write(vec: T) -> T:
-        nonlocal data
-        data.append(vec)
+def iter_csv_array(name: str, nchannels: int, dtype: Any = np.float64, chunk_size: int = 1 << 24) -> Iterator[np.ndarray]:
+    # (nchannels x n) blocks of a numeric csv (one sample per line), a chunk of the file at a time,
+    # without building per-field python objects
+    with open(name, 'rb') as inp:
+        tail = b''
+        while True:
+            chunk = inp.read(chunk_size)
+            buf = tail + chunk
+            if chunk:
+                cut = buf.rfind(b'\n') + 1
+                buf, tail = buf[:cut], buf[cut:]
+            if buf.strip():
+                vals = np.fromstring(buf.replace(b'\n', b',').decode('ascii'), dtype=dtype, sep=',')
+                if len(vals) % nchannels != 0:
+                    raise Exception('{}: expected {} values per line'.format(name, nchannels))
+                yield vals.reshape(-1, nchannels).T
+            if not chunk:
+                break
+
+
+def read_csv_array(name: str, nchannels: int, dtype: Any = np.float64, chunk_size: int = 1 << 24) -> np.ndarray:
+    # Parses a numeric csv straight into a preallocated (nchannels x nsamples) array, chunk by chunk.
+    # Decimal-to-float conversion bounds it: about the speed of np.loadtxt, tens of MB/s per core, far
+    # below disk reads. For repeated loads convert once to .npy (convert.py) and load that
+    with open(name, 'rb') as inp:
+        first = inp.readline()
+        inp.seek(0, 2)
+        size = inp.tell()
+    out = np.empty((nchannels, max(1, size // max(1, len(first)) + 1)), dtype=dtype)
+    n = 0
+    for block in iter_csv_array(name, nchannels, dtype, chunk_size):
+        rows = block.shape[1]
+        if n + rows > out.shape[1]:  # estimate from the first line was short
+            out = np.concatenate([out, np.empty((nchannels, max(rows, out.shape[1] // 2)), dtype=dtype)], axis=1)
+        out[:, n:n+rows] = block
+        n += rows
+    return out[:, :n]
+
+
+# csv recorder consumer: writes one scaled line per sample (of samples or nchannels x n blocks) as they come
+class Recorder:
+    def __init__(self, name: str = None, srate: int = 0, ext: str = 'csv', mode: str = 'w', scale: float = 1.0) -> None:
+        if not name:
+            name = f'{datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}_{srate}.{ext}'
+        self.name = 'records/' + name
+        self.scale = scale
+        self.out = open(self.name, mode)
+        self.m_rows = metrics.REGISTRY.counter('bci_recorder_rows_total', 'rows written by a recorder', {'file': self.name})
+        self.m_lag = metrics.REGISTRY.histogram('bci_recorder_lag_seconds', 'block arrival to written', {'file': self.name})
+
+    def __call__(self, vec: T) -> T:
+        if isinstance(vec, np.ndarray):
+            rows = vec.reshape(len(vec), -1).T * self.scale
+            for row in rows:
+                self.out.write(','.join([str(i) for i in row])+'\n')
+            self.m_rows.inc(len(rows))
+            t = getattr(vec, 't', -1.0)
+            if t >= 0:
+                self.m_lag.observe(timeline.clock() - t)
+        else:
+            print('{} is not a np.array'.format(vec))
         return vec
 
-    return write
+    def close(self) -> None:
+        if not self.out.closed:
+            print('INFO: Closing {}'.format(self.name))
+            self.out.close()
+
+
+def open_record(name: str = None, srate: int = 0, ext: str = 'csv', mode: str = 'w', scale: float = 1.0) -> Recorder:
+    return Recorder(name, srate, ext, mode, scale)
 
 def compact_duration(n: int) -> str:
     hours = n // 3600
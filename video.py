@@ -1,11 +1,85 @@
+from typing import Optional, List, Tuple
+import queue
+from threading import Thread, Event
+
 import numpy as np
 import cv2
 
+import timeline
+
+# frame index -> display time (seconds from t0 on timeline.clock)
+FRAME_LOG_DTYPE = np.dtype([('frame', '<u4'), ('t', '<f8')])
+
+
 class Video:
-    def __init__(self, fname: str):
+    def __init__(self, fname: str, ahead: int = 16):
         self.video = cv2.VideoCapture(fname)
         fps = self.video.get(cv2.CAP_PROP_FPS)
+        self.fps = fps
         self.wait = int(1000.0 / fps)
+        self.ahead = ahead
+        self.frames = queue.Queue(max(1, ahead)) # type: queue.Queue
+        self.should_run = Event()
+        self.log = [] # type: List[Tuple[int, float]]
+        self.dropped = 0
+
+    def _decode(self) -> None:
+        i = 0
+        try:
+            while self.should_run.is_set() and self.video.isOpened():
+                ret, frame = self.video.read()
+                if not ret:
+                    break
+                item = (i, cv2.cvtColor(frame, cv2.COLOR_RGB2RGBA))
+                while self.should_run.is_set():
+                    try:
+                        self.frames.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                i += 1
+        finally:
+            self.frames.put(None)
+
+    # Frame i is due i/fps after the first one; frames already a full period late are dropped, not shown.
+    # Display times are logged relative to t0 (default: first frame)
+    def run_clocked(self, t0: Optional[float] = None) -> None:
+        if self.video is None:
+            return
+        self.should_run.set()
+        decoder = Thread(target=self._decode, name='video-decode', daemon=True)
+        decoder.start()
+        period = 1.0 / self.fps
+        start = None # type: Optional[float]
+        finished = True
+        for i, frame in iter(self.frames.get, None):
+            if start is None:  # clock starts once the first frame is decoded
+                start = timeline.clock()
+                t0 = start if t0 is None else t0
+            target = start + i * period
+            if timeline.clock() > target + period:
+                self.dropped += 1
+                continue
+            timeline.wait_until(target)
+            cv2.imshow('frame', frame)
+            key = cv2.waitKey(1)  # frame gets painted here
+            self.log.append((i, timeline.clock() - t0))  # type: ignore
+            if key & 0xFF == ord('q'):
+                finished = False
+                break
+        self.should_run.clear()
+        while not finished and self.frames.get() is not None:  # unblock and drain decoder
+            pass
+        decoder.join()
+        self.video.release()
+        self.video = None
+        cv2.destroyAllWindows()
+
+    def frame_log(self) -> np.ndarray:
+        return np.array(self.log, dtype=FRAME_LOG_DTYPE)
+
+    def save_frame_log(self, fname: str) -> None:
+        np.save(fname, self.frame_log())
 
     def run(self) -> None:
         if self.video is None: